@@ -0,0 +1,63 @@
+""" Benchmark of the relevant slice selection done by DeepBrainSliceExtractor.transform
+for every volume: per-slice boolean scan of the brain quantity table (old) against
+the per-volume index built once at construction (new).
+Volumes are not needed, only deepbrain_image_data.pickle.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+
+from os.path import dirname
+import os
+import sys
+import time
+import pickle as pkl
+import numpy as np
+
+script_path = dirname(__file__)
+sys.path.append(script_path)
+
+from deep_brain_slice_extractor import build_brain_quantity_index, BRAIN_QUANTITY_THRESHOLD
+
+N_VOLUMES = 20
+
+
+def scan_selection(img_data, name_vol, n_slices):
+    selected = []
+    for id_sag_slice in range(n_slices):
+        name_slice = name_vol + '_' + str(id_sag_slice)
+        brain_q = int(img_data[img_data['ID']==name_slice]['BRAIN_QUANTITY'].iloc[0])
+        if brain_q>BRAIN_QUANTITY_THRESHOLD:
+            selected.append(id_sag_slice)
+    return np.array(selected)
+
+
+def index_selection(index, name_vol):
+    return np.flatnonzero(index[name_vol] > BRAIN_QUANTITY_THRESHOLD)
+
+
+if __name__ == "__main__":
+    with open(script_path+os.path.sep+'deepbrain_image_data.pickle', 'rb') as f:
+        db_image_data = pkl.load(f)
+
+    start = time.perf_counter()
+    index = build_brain_quantity_index(db_image_data)
+    build_time = time.perf_counter()-start
+    volumes = list(index.keys())[:N_VOLUMES]
+
+    scan_times, index_times = [], []
+    for name_vol in volumes:
+        start = time.perf_counter()
+        old = scan_selection(db_image_data, name_vol, len(index[name_vol]))
+        scan_times.append(time.perf_counter()-start)
+
+        start = time.perf_counter()
+        new = index_selection(index, name_vol)
+        index_times.append(time.perf_counter()-start)
+        assert np.array_equal(old, new), name_vol
+
+    print('Rows in brain quantity table:', len(db_image_data))
+    print('Index construction (once): {:.3f} s'.format(build_time))
+    print('Per-volume selection, boolean scan: {:.4f} s'.format(np.mean(scan_times)))
+    print('Per-volume selection, index:        {:.6f} s'.format(np.mean(index_times)))
+    print('Speed-up: {:.0f}x'.format(np.mean(scan_times)/np.mean(index_times)))
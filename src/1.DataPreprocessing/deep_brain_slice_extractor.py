@@ -10,15 +10,107 @@ warnings.filterwarnings("ignore")
 
 import pickle as pkl
 import glob
+import json
+import hashlib
 import numpy as np
 import pandas as pd
 import nibabel as nib
 from deepbrain import Extractor
 import os
 import warnings
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
+from PIL import Image
 warnings.filterwarnings("default")
 
+BRAIN_QUANTITY_THRESHOLD = 3000
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_sha1(path, chunk_size=1<<20):
+    """Content hash of a file, read in chunks."""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def build_brain_quantity_index(img_data):
+    """Group the per-slice brain quantity table by volume.
+
+    Slice IDs have the form '<volume name>_<sagittal slice index>', so the table is
+    split once into one vector per volume where position i holds the brain quantity
+    of slice i. Slices missing from the table are filled with 0 (never selected).
+
+    Args:
+        img_data (DataFrame): table with 'ID' and 'BRAIN_QUANTITY' columns.
+
+    Returns:
+        [dict]: volume name -> np.ndarray of brain quantities indexed by slice.
+    """
+    ids = img_data['ID'].str.rsplit('_', n=1, expand=True)
+    slices = pd.DataFrame({'VOL': ids[0].values,
+                           'SLICE': ids[1].astype(int).values,
+                           'BRAIN_QUANTITY': img_data['BRAIN_QUANTITY'].values})
+
+    index = dict()
+    for name_vol, vol_slices in slices.groupby('VOL', sort=False):
+        quantities = np.zeros(vol_slices['SLICE'].max()+1)
+        quantities[vol_slices['SLICE'].values] = vol_slices['BRAIN_QUANTITY'].values
+        index[name_vol] = quantities
+    return index
+
+
+def slice_store_paths(save_img_path, split):
+    """Paths of the memory-mapped slice store of a partition and its sidecar index.
+
+    Args:
+        save_img_path (str): output folder of the extractor.
+        split (str): 'train_and_val/' or 'test/'.
+
+    Returns:
+        [tuple]: (path of the N x 256 x 256 .npy array, path of the .csv index)
+    """
+    name = save_img_path + split.strip('/')
+    return name + '.npy', name + '_index.csv'
+
+
+def to_compact_dtype(slices, out_dtype=None):
+    """Cast slices to a compact dtype, recording the scale and offset needed to recover the intensities.
+
+    Volumes with negative voxels are shifted by their minimum (the offset) before being cast
+    to an unsigned out_dtype, instead of clipping the negatives to 0. Integer data whose
+    (shifted) range fits in an integer out_dtype is cast losslessly (scale 1). Otherwise the
+    slices are divided by a per-volume scale so their largest magnitude fits in out_dtype.
+
+    Args:
+        slices (np.ndarray): slices in the on-disk dtype of the volume.
+        out_dtype (str, optional): e.g. 'uint16', 'float16'. Defaults to None, keep the input dtype.
+
+    Returns:
+        [tuple]: (array in out_dtype, scale, offset) with original intensities ~= array * scale + offset
+    """
+    out_dtype = np.dtype(out_dtype) if out_dtype is not None else slices.dtype
+    if slices.size == 0 or out_dtype == slices.dtype:
+        return slices, 1.0, 0.0
+
+    info = np.iinfo(out_dtype) if np.issubdtype(out_dtype, np.integer) else np.finfo(out_dtype)
+    vmin, vmax = slices.min(), slices.max()
+    if np.issubdtype(out_dtype, np.integer):
+        offset = float(vmin) if vmin < 0 and info.min == 0 else 0.0
+        if np.issubdtype(slices.dtype, np.integer) and vmin-offset >= info.min and vmax-offset <= info.max:
+            return (slices.astype(np.int64)-int(offset)).astype(out_dtype), 1.0, offset
+        scale = max(abs(float(vmin)-offset), abs(float(vmax)-offset))/info.max or 1.0
+        return np.clip(np.round((slices-offset)/scale), info.min, info.max).astype(out_dtype), scale, offset
+
+    scale = max(1.0, float(max(abs(vmin), abs(vmax)))/float(info.max))
+    return (slices/scale).astype(out_dtype), scale, 0.0
+
+
+def save_gray_png(path, img_slice):
+    """Lossless single channel PNG of a uint8 (8-bit) or uint16 (16-bit) slice."""
+    Image.fromarray(np.ascontiguousarray(img_slice)).save(path, format='PNG')
 
 
 
@@ -31,7 +123,9 @@ class DeepBrainSliceExtractor:
                 img_data = None, 
                 trainval_ids = None, 
                 test_ids = None,
-                out_format = 'npy'):
+                out_format = 'npy',
+                out_dtype = None,
+                min_brain_quantity = BRAIN_QUANTITY_THRESHOLD):
         """[summary]
 
         Args:
@@ -41,6 +135,18 @@ class DeepBrainSliceExtractor:
             img_data ([DataFrame], optional): [description]. Defaults to None.
             trainval_ids ([iterable:int], optional): [description]. Defaults to None.
             test_ids ([iterable:int], optional): [description]. Defaults to None.
+            out_format (str, optional): 'npy', 'memmap', 'png' or any other image format accepted by
+                plt.imsave. 'png' slices are grayscale PNGs of out_dtype ('uint8' or 'uint16', the default) values,
+                so the intensities are kept; the other image formats are 8-bit colormapped images.
+                'memmap' packs every partition in one contiguous N x 256 x 256 .npy array (out_dtype)
+                plus a sidecar .csv index (SLICE_ID, IXI_ID, BRAIN_QUANTITY) instead of one file
+                per slice. Defaults to 'npy'.
+            out_dtype (str, optional): dtype of the saved slices, see to_compact_dtype. The scale
+                and offset applied to each volume are written to '<partition>_scales.csv': the
+                loaders read the saved values as they are. Defaults to None, the raw intensities
+                in the on-disk dtype of the volume (uint16 for 'png').
+            min_brain_quantity (int, optional): slices with more brain voxels than this are extracted.
+                Defaults to BRAIN_QUANTITY_THRESHOLD.
         """
 
         self.volume_folder = volume_folder
@@ -52,72 +158,312 @@ class DeepBrainSliceExtractor:
         self.trainval_ids = trainval_ids
         self.test_ids = test_ids
 
+        if out_format == 'png' and out_dtype is None:
+            out_dtype = 'uint16'
+        if out_format == 'png' and str(np.dtype(out_dtype)) not in ['uint8', 'uint16']:
+            raise Exception('png slices need out_dtype uint8 or uint16, not '+str(out_dtype))
         self.out_format = out_format
+        self.out_dtype = out_dtype
+        self.min_brain_quantity = min_brain_quantity
+        self.brain_quantity = None
+        self.store_offsets = dict()
 
         if self.pretrained:
             if isinstance(img_data, str):
                 self.path_img_data = img_data
-                with open(path_img_data, 'rb') as handle:
-                    img_data = pkl.load(handle)
+                with open(self.path_img_data, 'rb') as handle:
+                    self.img_data = img_data = pkl.load(handle)
 
             assert(isinstance(img_data, pd.DataFrame))
+            #ID -> BRAIN_QUANTITY lookup built once instead of scanning img_data for every slice
+            self.brain_quantity = build_brain_quantity_index(img_data)
 
     def fit(self):
         if self.pretrained:
             raise Exception("Brain data already extracted on img_data. For fitting, use 'pretrained'=False and img_data=None (Default)")
 
-    def transform(self, verbose = True):
-        counttrain, counttest = 0, 0
-        
-        for f in self.all_volume_files:
-            innercount = 0
+    def relevant_slices(self, name_vol):
+        """Sagittal slice indices of a volume with enough brain to be extracted.
 
-            name_vol = f.split('\\')[-1][:-7]
-            ixi_id = int(name_vol[3:6])
+        Args:
+            name_vol (str): volume name, e.g. 'IXI002-Guys-0828-T1'.
 
-            if ixi_id in self.trainval_ids:
-                split = 'train_and_val/'
-            elif ixi_id in self.test_ids:
-                split = 'test/'
-            else:
-                raise Exception('Volume DO NOT BELONG to any partition')
+        Returns:
+            [np.ndarray]: sorted slice indices whose brain quantity exceeds min_brain_quantity.
+        """
+        return np.flatnonzero(self.brain_quantity[name_vol] > self.min_brain_quantity)
+
+    def volume_split(self, name_vol):
+        """Partition folder of a volume, given by its IXI ID.
+
+        Args:
+            name_vol (str): volume name, e.g. 'IXI002-Guys-0828-T1'.
+
+        Returns:
+            [str]: 'train_and_val/' or 'test/'.
+        """
+        ixi_id = int(name_vol[3:6])
+        if ixi_id in self.trainval_ids:
+            return 'train_and_val/'
+        elif ixi_id in self.test_ids:
+            return 'test/'
+        else:
+            raise Exception('Volume DO NOT BELONG to any partition')
+
+    def extract_volume(self, f):
+        """Save the relevant sagittal slices of one volume.
 
-            if not os.path.isdir(self.save_img_path+split):
-                os.mkdir(self.save_img_path+split)
+        Output file names only depend on the volume name and the slice index,
+        so the result is the same whatever order or process the volume is handled in.
 
-            vol_np = nib.load(f).get_fdata()
-            for id_sag_slice in range(vol_np.shape[2]):
-                
+        Args:
+            f (str): path of the .nii.gz volume.
+
+        Returns:
+            [tuple]: (name_vol, split, number of slices saved, intensity scale, intensity offset)
+        """
+        name_vol = os.path.basename(f)[:-7]
+        split = self.volume_split(name_vol)
+        slice_ids = self.relevant_slices(name_vol)
+        if len(slice_ids) == 0:
+            return name_vol, split, 0, 1.0, 0.0
+
+        #Read through the array proxy in the on-disk dtype, and only the slab
+        #spanning the relevant slices, instead of the whole volume as float64
+        proxy = nib.load(f).dataobj
+        slab = np.asanyarray(proxy[:, :, slice_ids[0]:slice_ids[-1]+1])
+        slab = slab[:, :, slice_ids-slice_ids[0]]
+        #rot90 of every sagittal slice, slices first: k x 256 x 256
+        slices = np.moveaxis(np.rot90(slab, axes=(0,1)), 2, 0)
+        assert(slices.shape[1:]==(256,256))
+        slices, scale, offset = to_compact_dtype(slices, self.out_dtype)
+
+        if self.out_format == 'memmap':
+            first_row = self.store_offsets[name_vol]
+            store = np.load(slice_store_paths(self.save_img_path, split)[0], mmap_mode='r+')
+            store[first_row:first_row+len(slices)] = slices
+            store.flush()
+            del store
+        else:
+            for id_sag_slice, img_slice in zip(slice_ids, slices):
                 name_slice = name_vol + '_' + str(id_sag_slice)
+                if self.out_format == 'npy':
+                    np.save(self.save_img_path+split+name_slice, img_slice)
+                elif self.out_format == 'png':
+                    save_gray_png(self.save_img_path+split+name_slice+'.png', img_slice)
+                else:
+                    plt.imsave(self.save_img_path+split+name_slice+'.'+self.out_format,
+                               img_slice, format = self.out_format,
+                               cmap='gray')
 
-                brain_q = int(self.img_data[self.img_data['ID']==name_slice]['BRAIN_QUANTITY'])
-                if brain_q>3000:
-                    innercount += 1
-                    img_slice = np.rot90(vol_np[:,:,id_sag_slice])
-                    assert(img_slice.shape==(256,256))
-
-                    if self.out_format == 'npy':
-                        np.save(self.save_img_path+split+name_slice, img_slice)
-                    else:
-                        plt.imsave(self.save_img_path+split+name_slice+'.'+self.out_format,
-                                   img_slice, format = self.out_format,
-                                   cmap='gray')
-
-            if split == 'train_and_val/':
-                counttrain += innercount
-            else:
-                counttest += innercount
+        return name_vol, split, len(slices), scale, offset
 
-            if verbose:
-                print(ixi_id,'-', split,'-', name_vol)
-                print('\tRelevant vol. slices:', innercount)
-                print('\tTotal Train and Val:', counttrain)
-                print('\tTotal Test:', counttest)
-                print()
-                print('--------------') 
+    def slice_store_layout(self, volume_files):
+        """Row offset of every volume in its partition store and the rows of every store.
 
-            
+        The number of relevant slices of each volume is known from the brain quantity
+        index, so every volume gets a fixed row offset in its partition store before
+        extraction starts and workers can fill their rows independently.
 
+        Args:
+            volume_files (list): sorted paths of the volumes to extract.
+
+        Returns:
+            [tuple]: (dict name_vol -> offset, dict split -> list of (SLICE_ID, IXI_ID, BRAIN_QUANTITY))
+        """
+        rows = dict()
+        offsets = dict()
+        for f in volume_files:
+            name_vol = os.path.basename(f)[:-7]
+            split = self.volume_split(name_vol)
+            split_rows = rows.setdefault(split, [])
+            offsets[name_vol] = len(split_rows)
+            for id_sag_slice in self.relevant_slices(name_vol):
+                split_rows.append((name_vol + '_' + str(id_sag_slice),
+                                   int(name_vol[3:6]),
+                                   self.brain_quantity[name_vol][id_sag_slice]))
+        return offsets, rows
+
+    def create_slice_stores(self, rows):
+        """Preallocate the memory-mapped store of every partition and write its sidecar index.
+
+        Args:
+            rows (dict): split -> list of (SLICE_ID, IXI_ID, BRAIN_QUANTITY), see slice_store_layout.
+        """
+        for split, split_rows in rows.items():
+            store_path, index_path = slice_store_paths(self.save_img_path, split)
+            store_dtype = self.out_dtype if self.out_dtype is not None else np.float32
+            store = np.lib.format.open_memmap(store_path, mode='w+', dtype=store_dtype,
+                                              shape=(len(split_rows), 256, 256))
+            del store
+            pd.DataFrame(split_rows, columns=['SLICE_ID', 'IXI_ID', 'BRAIN_QUANTITY']).to_csv(index_path, index=False)
+
+    def settings(self):
+        """Extraction options that change the output; a manifest written with others is discarded."""
+        settings = {'out_format': self.out_format,
+                    'out_dtype': None if self.out_dtype is None else str(np.dtype(self.out_dtype)),
+                    'min_brain_quantity': self.min_brain_quantity}
+        if self.out_format == 'png':
+            #slices of manifests without it are matplotlib RGBA images
+            settings['png'] = 'grayscale'
+        #slices of manifests without it had their negative voxels clipped to 0
+        settings['intensity'] = 'scale_offset'
+        return settings
+
+    def load_manifest(self):
+        """Manifest of a previous run in save_img_path, or an empty one.
+
+        Returns:
+            [dict]: {'settings': ..., 'layout': ..., 'volumes': {abs. volume path: record}}
+                where every record holds size, mtime, sha1, slices, split, scale and offset of a processed volume.
+        """
+        manifest_path = self.save_img_path + MANIFEST_NAME
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as handle:
+                manifest = json.load(handle)
+            if manifest.get('settings') == self.settings():
+                return manifest
+        return {'settings': self.settings(), 'layout': None, 'volumes': dict()}
+
+    def save_manifest(self, manifest):
+        """Write the manifest atomically, so a crash never leaves it half written."""
+        manifest_path = self.save_img_path + MANIFEST_NAME
+        with open(manifest_path + '.tmp', 'w') as handle:
+            json.dump(manifest, handle, indent=1)
+        os.replace(manifest_path + '.tmp', manifest_path)
+
+    def is_processed(self, f, record):
+        """Whether the manifest record of a volume still matches the file on disk.
+
+        Size and mtime are checked first; the content hash is only computed when the
+        mtime changed, so touched but identical volumes are not extracted again.
+        """
+        if record is None:
+            return False
+        stat = os.stat(f)
+        if stat.st_size != record['size']:
+            return False
+        if stat.st_mtime != record['mtime'] and file_sha1(f) != record['sha1']:
+            return False
+        record['mtime'] = stat.st_mtime
+        return True
+
+    def transform(self, verbose = True, n_jobs = 1, incremental = True):
+        """Extract the relevant slices of every volume in volume_folder.
+
+        Every processed volume is recorded in a manifest in save_img_path (path, size,
+        mtime, content hash, slices written, partition) right after it is written.
+
+        Args:
+            verbose (bool, optional): print counters after each volume. Defaults to True.
+            n_jobs (int, optional): number of worker processes. Volumes are sharded across
+                the pool; 1 extracts serially in this process, None uses every core. Defaults to 1.
+            incremental (bool, optional): skip volumes already in the manifest and unchanged,
+                so a crashed run resumes and new or modified volumes are the only ones extracted.
+                With out_format='memmap' the stores are rebuilt if the set of volumes changed.
+                Defaults to True.
+
+        Returns:
+            [tuple]: (counttrain, counttest) number of slices in each partition.
+        """
+        counttrain, counttest = 0, 0
+        scales = dict()
+        volume_files = sorted(self.all_volume_files)
+
+        if not os.path.isdir(self.save_img_path):
+            os.makedirs(self.save_img_path)
+        manifest = self.load_manifest() if incremental else {'settings': self.settings(),
+                                                             'layout': None,
+                                                             'volumes': dict()}
+        records = manifest['volumes']
+        records = {path: records[path] for path in map(os.path.abspath, volume_files) if path in records}
+
+        #Create outputs before sharding, so workers never race on them
+        if self.out_format == 'memmap':
+            self.store_offsets, rows = self.slice_store_layout(volume_files)
+            layout = {'offsets': self.store_offsets,
+                      'rows': {split: len(split_rows) for split, split_rows in rows.items()}}
+            stores_exist = all(os.path.isfile(slice_store_paths(self.save_img_path, split)[0]) for split in rows)
+            if manifest['layout'] != layout or not stores_exist:
+                self.create_slice_stores(rows)
+                records = dict()
+            manifest['layout'] = layout
+        else:
+            for split in set(self.volume_split(os.path.basename(f)[:-7]) for f in volume_files):
+                if not os.path.isdir(self.save_img_path+split):
+                    os.makedirs(self.save_img_path+split)
+
+        manifest['volumes'] = records
+        pending = [f for f in volume_files if not self.is_processed(f, records.get(os.path.abspath(f)))]
+        pending_set = set(pending)
+        done = [records[os.path.abspath(f)] for f in volume_files if f not in pending_set]
+        self.save_manifest(manifest)
+
+        for record in done:
+            scales.setdefault(record['split'], []).append((record['name'], record['scale'], record['offset']))
+            if record['split'] == 'train_and_val/':
+                counttrain += record['slices']
+            else:
+                counttest += record['slices']
+        if verbose and done:
+            print(len(done), 'volumes already extracted, skipped')
+            print('--------------')
+
+        if n_jobs == 1:
+            pool = None
+            results = map(self.extract_volume, pending)
+        else:
+            pool = Pool(processes=n_jobs, initializer=_init_worker, initargs=(self,))
+            #imap keeps the input order, so counters and logs are deterministic
+            results = pool.imap(_extract_volume_worker, pending)
+
+        try:
+            for f, (name_vol, split, innercount, scale, offset) in zip(pending, results):
+                stat = os.stat(f)
+                records[os.path.abspath(f)] = {'name': name_vol,
+                                               'size': stat.st_size,
+                                               'mtime': stat.st_mtime,
+                                               'sha1': file_sha1(f),
+                                               'slices': innercount,
+                                               'split': split,
+                                               'scale': scale,
+                                               'offset': offset}
+                self.save_manifest(manifest)
+
+                scales.setdefault(split, []).append((name_vol, scale, offset))
+                if split == 'train_and_val/':
+                    counttrain += innercount
+                else:
+                    counttest += innercount
+
+                if verbose:
+                    print(int(name_vol[3:6]),'-', split,'-', name_vol)
+                    print('\tRelevant vol. slices:', innercount)
+                    print('\tTotal Train and Val:', counttrain)
+                    print('\tTotal Test:', counttest)
+                    print()
+                    print('--------------') 
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        for split, split_scales in scales.items():
+            pd.DataFrame(sorted(split_scales), columns=['VOLUME', 'SCALE', 'OFFSET']).to_csv(
+                self.save_img_path+split.strip('/')+'_scales.csv', index=False)
+
+        return counttrain, counttest
+
+
+_worker_extractor = None
+
+def _init_worker(extractor):
+    """Keep one copy of the extractor (and its brain quantity index) per worker process."""
+    global _worker_extractor
+    _worker_extractor = extractor
+
+def _extract_volume_worker(f):
+    return _worker_extractor.extract_volume(f)
 
 
 if __name__ == "__main__":
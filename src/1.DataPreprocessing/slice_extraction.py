@@ -27,7 +27,8 @@ with open(script_path+os.path.sep+'..'+os.path.sep+'2.Experiments'+os.path.sep+'
     train_val_vols = pkl.load(f)
 
 
-OUTFORMAT = 'png'
+OUTFORMAT = 'png' #'npy', 'memmap' (one array per partition), 'png' (16-bit grayscale) or another image format
+N_JOBS = os.cpu_count() #worker processes used to extract the volumes
 SAVE_PATH  =script_path+os.path.sep+'..'+os.path.sep+'IXI-T1'+os.path.sep+'PNG'+os.path.sep
 
 test_vols = test_vols.IXI_ID.values
@@ -41,4 +42,5 @@ se = DeepBrainSliceExtractor(volume_folder = script_path+os.path.sep+'..'+os.pat
                              test_ids=test_vols,
                              out_format=OUTFORMAT)
 
-se.transform()
\ No newline at end of file
+if __name__ == "__main__":
+    se.transform(n_jobs=N_JOBS)
\ No newline at end of file
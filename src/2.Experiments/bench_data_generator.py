@@ -0,0 +1,89 @@
+""" Throughput and peak memory of my_data_loader.DataGenerator per batch size, against the
+previous implementation (float64 batches and a copied target).
+Every configuration iterates two epochs over synthetic 256x256 uint16 .npy slices in its own
+process, so the peak RSS (export_model.peak_rss_mb) only accounts for that configuration
+(the prefetch worker processes are not included). After every batch the consumer sleeps
+TRAIN_STEP_MS, standing for a GPU training step that leaves the CPU to the loader: prefetching
+overlaps loading with it. Only the second epoch is timed, the first one includes starting the
+pool (each prefetch process imports TensorFlow).
+uint8 batches are scaled to [0, 1] by the model, so they are not comparable in values.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+BATCH_SIZES = [8, 16, 32, 64, 128]
+N_SLICES = 1024
+TRAIN_STEP_MS = 20
+CONFIGS = {'previous (float64, copy)': dict(),
+           'float32': dict(dtype='float32'),
+           'float32 ring': dict(dtype='float32', n_buffers=4),
+           'float16 ring': dict(dtype='float16', n_buffers=4),
+           'uint8 ring': dict(dtype='uint8', n_buffers=4),
+           'float32 prefetch threads': dict(dtype='float32', prefetch=8, prefetch_workers=4),
+           'float32 prefetch processes': dict(dtype='float32', prefetch=8, prefetch_workers=4,
+                                              prefetch_mode='process')}
+
+
+def previous_generator(list_IDs, batch_size):
+    """Previous DataGenerator: float64 batch and a copy of it as target."""
+    from my_data_loader import DataGenerator
+
+    class PreviousDataGenerator(DataGenerator):
+        def __getitem__(self, index):
+            indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
+            X = np.empty((self.batch_size, *self.dim, self.n_channels))
+            for i, k in enumerate(indexes):
+                X[i,] = np.expand_dims(np.load(self.list_IDs[k]), axis=2)
+            return X, X.copy()
+
+    return PreviousDataGenerator(list_IDs, batch_size=batch_size)
+
+
+def epoch_throughput(list_IDs, batch_size, config):
+    from my_data_loader import DataGenerator
+    from export_model import peak_rss_mb
+
+    generator = (DataGenerator(list_IDs, batch_size=batch_size, **config) if config
+                 else previous_generator(list_IDs, batch_size))
+    for epoch in range(2):
+        start = time.perf_counter()
+        for i in range(len(generator)):
+            batch_x, batch_y = generator[i]
+            time.sleep(TRAIN_STEP_MS / 1000)
+        elapsed = time.perf_counter() - start
+        generator.on_epoch_end()
+    generator.close()
+    return len(generator) / elapsed, peak_rss_mb()
+
+
+def synthetic_slices(folder, n_slices, rng):
+    paths = []
+    for i in range(n_slices):
+        paths.append(os.path.join(folder, 'slice_'+str(i)+'.npy'))
+        np.save(paths[-1], rng.integers(0, 4096, (256, 256), dtype=np.uint16))
+    return paths
+
+
+if __name__ == "__main__":
+    folder = tempfile.mkdtemp()
+    try:
+        list_IDs = synthetic_slices(folder, N_SLICES, np.random.default_rng(0))
+        context = multiprocessing.get_context('spawn')
+        for batch_size in BATCH_SIZES:
+            print('batch size', batch_size)
+            for name, config in CONFIGS.items():
+                #not a multiprocessing.Pool: its daemonic workers cannot start the prefetch processes
+                with ProcessPoolExecutor(1, mp_context=context) as pool:
+                    batches_s, rss = pool.submit(epoch_throughput, list_IDs, batch_size, config).result()
+                print('  {:<28} {:8.1f} batches/s  peak RSS {:8.1f} MB'.format(name, batches_s, rss or float('nan')))
+    finally:
+        shutil.rmtree(folder)
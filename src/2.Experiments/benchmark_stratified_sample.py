@@ -0,0 +1,74 @@
+""" Benchmark of stratifier_complex.stratified_sample against the previous implementation,
+which built a df.query() string per stratum and appended every stratum sample.
+Both must return the same rows for the same seed.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+
+import time
+import numpy as np
+import pandas as pd
+from stratifier_complex import stratified_sample, stratified_sample_report
+
+N_ROWS = [10_000, 100_000, 1_000_000]
+STRATA = ['ETHNIC_ID', 'AGE_GROUP', 'SEX', 'SITE']
+SIZE = 0.15
+SEED = 42
+
+
+def query_stratified_sample(df, strata, size=None, seed=None, keep_index=True):
+    """Previous implementation, with pd.concat in place of the removed DataFrame.append."""
+    tmp_grpd = stratified_sample_report(df, strata, size)
+
+    first = True
+    for i in range(len(tmp_grpd)):
+        qry=''
+        for s in range(len(strata)):
+            stratum = strata[s]
+            value = tmp_grpd.iloc[i][stratum]
+            n = tmp_grpd.iloc[i]['samp_size']
+
+            if type(value) == str:
+                value = "'" + str(value) + "'"
+
+            if s != len(strata)-1:
+                qry = qry + stratum + ' == ' + str(value) +' & '
+            else:
+                qry = qry + stratum + ' == ' + str(value)
+
+        if first:
+            stratified_df = df.query(qry).sample(n=n, random_state=seed).reset_index(drop=(not keep_index))
+            first = False
+        else:
+            tmp_df = df.query(qry).sample(n=n, random_state=seed).reset_index(drop=(not keep_index))
+            stratified_df = pd.concat([stratified_df, tmp_df], ignore_index=True)
+
+    return stratified_df
+
+
+def synthetic_volumes(n_rows, rng):
+    return pd.DataFrame({'IXI_ID': np.arange(n_rows),
+                         'ETHNIC_ID': rng.integers(1, 3, n_rows),
+                         'AGE_GROUP': rng.choice(['young', 'adult', 'elderly'], n_rows),
+                         'SEX': rng.integers(1, 3, n_rows),
+                         'SITE': rng.choice(['Guys', 'HH', 'IOP'], n_rows),
+                         'AGE': rng.uniform(20, 86, n_rows)})
+
+
+if __name__ == "__main__":
+    rng = np.random.default_rng(0)
+    for n_rows in N_ROWS:
+        df = synthetic_volumes(n_rows, rng)
+
+        start = time.perf_counter()
+        old = query_stratified_sample(df, STRATA, size=SIZE, seed=SEED)
+        old_time = time.perf_counter()-start
+
+        start = time.perf_counter()
+        new = stratified_sample(df, STRATA, size=SIZE, seed=SEED)
+        new_time = time.perf_counter()-start
+
+        pd.testing.assert_frame_equal(old, new)
+        print('{:>9} rows, {} strata: query {:.3f} s - groupby {:.3f} s - {:.1f}x'.format(
+              n_rows, len(STRATA), old_time, new_time, old_time/new_time))
@@ -0,0 +1,56 @@
+""" Training throughput of every architecture option of residual_cae_experiment.py in
+float32, mixed precision, XLA and mixed precision + XLA.
+Each run trains on synthetic 128x128 images in its own process (the precision policy and
+XLA settings are global) and reports the median step time of the second epoch, after tracing.
+Mixed precision only pays off on GPUs with float16 units (compute capability >= 7.0);
+on CPU float16 is emulated and much slower.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+
+import multiprocessing
+import numpy as np
+
+ARCHITECTURES = ['small_res_cae', 'myronenko_cae', 'skip_con_cae', 'res_skip_cae']
+MODES = {'float32': (False, False),
+         'mixed_float16': (True, False),
+         'xla': (False, True),
+         'mixed_float16+xla': (True, True)}
+BATCH_SIZE = 32
+STEPS = 50
+
+
+def train_throughput(architecture, mixed_precision, xla, batch_size=BATCH_SIZE, steps=STEPS):
+    import tensorflow as tf
+    from tensorflow.keras.optimizers import RMSprop
+    from training_modes import set_mixed_precision, float32_output_head, xla_compile_kwargs, StepTimeLogger
+    from export_model import builders
+
+    set_mixed_precision(mixed_precision)
+    model = builders()[architecture]()
+    if mixed_precision:
+        model = float32_output_head(model)
+    model.compile(loss='mse', optimizer=RMSprop(), **xla_compile_kwargs(xla))
+
+    images = tf.random.uniform((batch_size*4, 128, 128, 1), seed=0)
+    ds = tf.data.Dataset.from_tensor_slices(images).batch(batch_size).repeat().map(lambda x: (x, x))
+    history = model.fit(ds, epochs=2, steps_per_epoch=steps, verbose=0, callbacks=[StepTimeLogger(batch_size)])
+    return history.history['step_time_ms'][-1], history.history['images_per_s'][-1]
+
+
+if __name__ == "__main__":
+    context = multiprocessing.get_context('spawn')
+    for architecture in ARCHITECTURES:
+        print(architecture)
+        reference = None
+        for mode, (mixed_precision, xla) in MODES.items():
+            with context.Pool(1) as pool:
+                try:
+                    step_time, images_s = pool.apply(train_throughput, (architecture, mixed_precision, xla))
+                except Exception as e:
+                    print('  {:<18} failed: {}'.format(mode, str(e).splitlines()[0] if str(e) else type(e).__name__))
+                    continue
+            reference = reference or images_s
+            print('  {:<18} step {:8.2f} ms  {:8.1f} images/s  {:.2f}x'.format(mode, step_time, images_s,
+                                                                               images_s/reference))
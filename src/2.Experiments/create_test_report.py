@@ -6,6 +6,8 @@ __version__ = "1.0.0"
 import glob
 import tensorflow as tf
 from my_tf_data_loader_optimized import tf_data_png_loader
+from model_registry import ModelRegistry
+from metric_store import MetricStore, weights_key
 import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
@@ -17,7 +19,8 @@ from copy import deepcopy
 pd.set_option("display.precision", 10)
 
 physical_devices = tf.config.experimental.list_physical_devices('GPU')
-tf.config.experimental.set_memory_growth(physical_devices[0], True)
+if physical_devices: #CPU-only boxes (e.g. quantized model evaluation)
+    tf.config.experimental.set_memory_growth(physical_devices[0], True)
 
 
 def DSSIM(y_true, y_pred):
@@ -28,9 +31,24 @@ def PSNR(y_true, y_pred):
 
 class TestMetricWrapper():
 
-    def __init__(self, models_folders_paths, test_files_path):
+    def __init__(self, models_folders_paths, test_files_path, model_memory_budget_mb=2048, metric_store_path=None):
+        """
+        Args:
+            models_folders_paths (list): result folders, each with one .h5 model and its .csv log.
+            test_files_path (list): test .png slices.
+            model_memory_budget_mb (int, optional): memory for the models cached between methods,
+                least recently used models are dropped beyond it. Defaults to 2048.
+            metric_store_path (str, optional): folder of the per-image metric store. Models already
+                stored for these test files, with the weights of their current .h5, are not
+                evaluated again. Defaults to None, no store.
+        """
 
         self.models_folders_paths = models_folders_paths
+        #each .h5 is deserialized once and shared by every method
+        self.models = ModelRegistry(custom_objects = {'DSSIM':DSSIM,
+                                                      'PSNR':PSNR
+                                                      },
+                                    memory_budget_mb = model_memory_budget_mb)
         self.test_files_path = test_files_path
 
         params = {'batch_size': 8,
@@ -44,6 +62,8 @@ class TestMetricWrapper():
         self.df_t_loss = None
         self.df_v_loss = None
         self.keras_evaluation = None
+        self.individual_metrics = dict()
+        self.metric_store = MetricStore(metric_store_path) if metric_store_path is not None else None
 
     def get_training_df(self):
         """
@@ -75,12 +95,7 @@ class TestMetricWrapper():
     def get_keras_evaluation(self, return_type='dict', verbose=2):
         keras_evaluation = {}
         for model_folder in self.models_folders_paths:
-            model_path = glob.glob(model_folder+'\\*.h5')[0]
-            model_trained = tf.keras.models.load_model(model_path, custom_objects = {'DSSIM':DSSIM,
-                                                                           'PSNR':PSNR
-                                                                           }
-                                            )
-            model_name = model_path.split('\\')[-1][:-3]
+            model_name, model_trained = self.models.get(model_folder)
             print(model_name, end=' - ')
             result = model_trained.evaluate(self.test_ds, verbose=verbose)
             result = result if isinstance(result, list) else [result]
@@ -104,44 +119,11 @@ class TestMetricWrapper():
             custom_evaluation[dict|type]: dictionary or dataframe with metric of test evaluations
         """
         custom_evaluation = dict()
-        for model_folder in self.models_folders_paths:
-            model_path = glob.glob(model_folder+'\\*.h5')[0]
-            model = tf.keras.models.load_model(model_path, custom_objects = {'DSSIM':DSSIM,
-                                                                           'PSNR':PSNR
-                                                                           }
-                                            )
-            model_name = model_path.split('\\')[-1][:-3]
-            if verbose: print(model_name, end=' - ')
+        self._evaluate_individual_metrics()
 
-            #get predicted images
-            predicted = model.predict(self.test_ds)
-            i=0
-            mse_metrics = []
-            dssim_metrics = []
-            psnr_metrics = []
-            for batchx, batchy in self.test_ds:
-                for x,y in zip(batchx, batchy):
-                    mse_metrics.append(self._mserror(y, predicted[i]).numpy())
-                    dssim_metrics.append(self._dssim(y, predicted[i]).numpy())
-                    psnr_metrics.append(self._psnr(y, predicted[i]).numpy())
-                    i+=1
-
-            custom_evaluation[model_name] = dict()
-            custom_evaluation[model_name]['mse_mean'] = mean_mse = np.mean(mse_metrics)
-            custom_evaluation[model_name]['mse_std'] = std_mse = np.std(mse_metrics)
-
-            custom_evaluation[model_name]['dssim_mean'] = mean_dssim = np.mean(dssim_metrics)
-            custom_evaluation[model_name]['dssim_std'] = std_dssim = np.std(dssim_metrics)
-
-            custom_evaluation[model_name]['psnr_mean'] = mean_psnr = np.mean(psnr_metrics)
-            custom_evaluation[model_name]['psnr_std'] = std_psnr =np.std(psnr_metrics)
-
-            if verbose:
-                print( "MSE: {:.2e}+-{:.2e} - DSSIM: {:.2e}+-{:.2e} - PSNR: {:.2e}+-{:.2e}".format(mean_mse, std_mse,
-                                                                                            mean_dssim, std_dssim,
-                                                                                            mean_psnr, std_psnr
-                                                                                            ))
-                print()
+        for model_folder in self.models_folders_paths:
+            model_name = self.models.model_name(model_folder)
+            custom_evaluation[model_name] = self._metrics_summary(model_name, verbose)
 
         self.custom_evaluation = custom_evaluation
         if return_type=='dict': 
@@ -149,6 +131,179 @@ class TestMetricWrapper():
         else:
             return pd.DataFrame.from_dict(custom_evaluation, orient='index')
 
+    def get_predictor_evaluation(self, predictors, verbose=False, return_type='dict'):
+        """Mean and std of MSE, DSSIM and PSNR on the test set of models that are not Keras .h5
+        (e.g. TFLite or quantized variants), with the same per-image metrics as get_custom_evaluation.
+
+        Args:
+            predictors (dict): name -> function from a numpy batch to its numpy reconstruction.
+            verbose (bool, optional): verbose.
+            return_type(str, optional): data type of return.
+
+        Returns:
+            custom_evaluation[dict|type]: dictionary or dataframe with metric of test evaluations
+        """
+        evaluation = dict()
+        for name, predict in predictors.items():
+            if name not in self.individual_metrics and not self._load_stored_metrics(name):
+                metrics = np.empty((3, len(self.test_files_path)), dtype=np.float32)
+                i = 0
+                for batchx, batchy in self.test_ds:
+                    predicted = tf.constant(predict(batchx.numpy()), dtype=tf.float32)
+                    n = int(batchx.shape[0])
+                    for row, values in enumerate(self._batch_metrics(batchy, predicted)):
+                        metrics[row, i:i+n] = values.numpy()
+                    i += n
+                self.individual_metrics[name] = {'mse': metrics[0,:i], 'dssim': metrics[1,:i], 'psnr': metrics[2,:i]}
+                if self.metric_store is not None:
+                    self.metric_store.append(name, self.test_files_path, self.individual_metrics[name])
+            evaluation[name] = self._metrics_summary(name, verbose)
+
+        if return_type=='dict': 
+            return evaluation
+        else:
+            return pd.DataFrame.from_dict(evaluation, orient='index')
+
+    def _metrics_summary(self, model_name, verbose=False):
+        """Mean and std of the per-image metrics of a model already in self.individual_metrics."""
+        if verbose: print(model_name, end=' - ')
+        mse_metrics = self.individual_metrics[model_name]['mse']
+        dssim_metrics = self.individual_metrics[model_name]['dssim']
+        psnr_metrics = self.individual_metrics[model_name]['psnr']
+
+        summary = dict()
+        summary['mse_mean'] = mean_mse = np.mean(mse_metrics)
+        summary['mse_std'] = std_mse = np.std(mse_metrics)
+
+        summary['dssim_mean'] = mean_dssim = np.mean(dssim_metrics)
+        summary['dssim_std'] = std_dssim = np.std(dssim_metrics)
+
+        summary['psnr_mean'] = mean_psnr = np.mean(psnr_metrics)
+        summary['psnr_std'] = std_psnr =np.std(psnr_metrics)
+
+        if verbose:
+            print( "MSE: {:.2e}+-{:.2e} - DSSIM: {:.2e}+-{:.2e} - PSNR: {:.2e}+-{:.2e}".format(mean_mse, std_mse,
+                                                                                        mean_dssim, std_dssim,
+                                                                                        mean_psnr, std_psnr
+                                                                                        ))
+            print()
+        return summary
+
+    def get_individual_metrics(self):
+        """Per-image metrics of every model, as saved in individual_metrics.pickle for the t-tests.
+
+        Returns:
+            [dict]: model name -> {'mses', 'mse_mean', 'mse_std', 'dssims', ..., 'psnr_std'}
+        """
+        self._evaluate_individual_metrics()
+        individual = dict()
+        for model_folder in self.models_folders_paths:
+            model_name = self.models.model_name(model_folder)
+            individual[model_name] = dict()
+            for m in ['mse', 'dssim', 'psnr']:
+                values = self.individual_metrics[model_name][m]
+                individual[model_name][m+'s'] = values.tolist()
+                individual[model_name][m+'_mean'] = np.mean(values)
+                individual[model_name][m+'_std'] = np.std(values)
+        return individual
+
+    def _evaluate_individual_metrics(self):
+        """Fill self.individual_metrics, reading the models found in the metric store and
+        evaluating (and storing) only the missing ones."""
+        pending, weights = [], dict()
+        for model_folder in self.models_folders_paths:
+            model_name = self.models.model_name(model_folder)
+            if model_name in self.individual_metrics:
+                continue
+            if self.metric_store is not None:
+                weights[model_name] = weights_key(self.models.model_path(model_folder))
+            if not self._load_stored_metrics(model_name, weights.get(model_name)):
+                pending.append(model_folder)
+
+        #one pass over the test set per group of models that fit in the memory budget:
+        #every batch is decoded once and fed to all the models of the group
+        for model_group in self._model_groups(pending):
+            group_metrics = self._fused_evaluation(model_group)
+            self.individual_metrics.update(group_metrics)
+            if self.metric_store is not None:
+                for model_name, metrics in group_metrics.items():
+                    self.metric_store.append(model_name, self.test_files_path, metrics, weights[model_name])
+
+    def _load_stored_metrics(self, model_name, weights=None):
+        """Read the per-image metrics of a model from the metric store into self.individual_metrics.
+
+        Args:
+            model_name (str): name of the model.
+            weights (str, optional): weights_key of its .h5, see MetricStore.has_model. Defaults to None.
+
+        Returns:
+            [bool]: False if there is no store or the model is not stored for these test files
+                (and weights)
+        """
+        if self.metric_store is None or not self.metric_store.has_model(model_name, self.test_files_path, weights):
+            return False
+        #rows in the order of self.test_files_path, paired with the models evaluated now
+        df = self.metric_store.load([model_name], files=self.test_files_path)
+        self.individual_metrics[model_name] = {m: df[m.upper()].to_numpy() for m in ['mse', 'dssim', 'psnr']}
+        return True
+
+    def _model_groups(self, model_folders):
+        """Split models in groups whose .h5 files (an upper bound of their weights) fit together
+        in the model memory budget.
+
+        Yields:
+            [dict]: model name -> model, for every group
+        """
+        group, group_bytes = dict(), 0
+        for model_folder in model_folders:
+            nbytes = os.path.getsize(self.models.model_path(model_folder))
+            if group and group_bytes + nbytes > self.models.memory_budget:
+                yield group
+                group, group_bytes = dict(), 0
+            model_name, model = self.models.get(model_folder)
+            group[model_name] = model
+            group_bytes += nbytes
+        if group:
+            yield group
+
+    def _fused_evaluation(self, models):
+        """Per-image MSE, DSSIM and PSNR of several models on the test set, in a single pass.
+
+        Every batch is decoded once, predicted by all the models and measured inside one
+        compiled function, and the results are copied once per batch into preallocated arrays.
+
+        Args:
+            models (dict): model name -> model.
+
+        Returns:
+            [dict]: model name -> {'mse', 'dssim', 'psnr'} np.ndarray with one value per test
+                image, in test_ds order.
+        """
+        names = list(models)
+
+        @tf.function
+        def evaluation_step(batchx, batchy):
+            return [self._batch_metrics(batchy, models[name](batchx, training=False)) for name in names]
+
+        metrics = np.empty((len(names), 3, len(self.test_files_path)), dtype=np.float32)
+        i = 0
+        for batchx, batchy in self.test_ds:
+            batch_metrics = evaluation_step(batchx, batchy)
+            n = int(batchx.shape[0])
+            for m, model_metrics in enumerate(batch_metrics):
+                for row, values in enumerate(model_metrics):
+                    metrics[m, row, i:i+n] = values.numpy()
+            i += n
+        return {name: {'mse': metrics[m,0,:i], 'dssim': metrics[m,1,:i], 'psnr': metrics[m,2,:i]}
+                for m, name in enumerate(names)}
+
+    def _batch_metrics(self, y, predicted):
+        """Per-image MSE, DSSIM and PSNR of a batch, same values as _mserror, _dssim and _psnr."""
+        mse = tf.math.reduce_mean(tf.math.squared_difference(y, predicted), axis=[1,2,3])
+        dssim = tf.math.divide(tf.subtract(1., tf.image.ssim(y, predicted, max_val=1.0)), 2)
+        psnr = tf.image.psnr(y, predicted, max_val=1.0)
+        return mse, dssim, psnr
+
     def plot_custom_metrics(self,figsize=(20,5)):
         fig, axs = plt.subplots(1,3, figsize=figsize)
         df = pd.DataFrame.from_dict(self.custom_evaluation, orient='index')
@@ -207,12 +362,7 @@ class TestMetricWrapper():
             idx_img+=1
         #Show predicted images
         for i, model_folder in enumerate(self.models_folders_paths):
-            model_path = glob.glob(model_folder+'\\*.h5')[0]
-            model = tf.keras.models.load_model(model_path, custom_objects = {'DSSIM':DSSIM,
-                                                                           'PSNR':PSNR
-                                                                           }
-                                            )
-            model_name = model_path.split('\\')[-1][:-3]
+            model_name, model = self.models.get(model_folder)
             #get predicted images
             predicted = model.predict(selected_files_ds)
             for j, img_out in enumerate(predicted):
@@ -276,12 +426,7 @@ class TestMetricWrapper():
             idx_img+=1
         #Show predicted images
         for i, model_folder in enumerate(self.models_folders_paths):
-            model_path = glob.glob(model_folder+'\\*.h5')[0]
-            model = tf.keras.models.load_model(model_path, custom_objects = {'DSSIM':DSSIM,
-                                                                           'PSNR':PSNR
-                                                                           }
-                                               )
-            model_name = model_path.split('\\')[-1][:-3]
+            model_name, model = self.models.get(model_folder)
             #get predicted images
             predicted = model.predict(input_images_ds)
             for j, img_out in enumerate(predicted):
@@ -317,7 +462,7 @@ class TestMetricWrapper():
 
         # Read image
         img = tf.io.read_file(selected_file)
-        img = tf.io.decode_png(img, channels=1)
+        img = tf.io.decode_png(img, channels=1, dtype=tf.uint16)
         img = tf.image.convert_image_dtype(img, tf.float32)
         img = tf.image.resize(img, (128,128))
         img = self._scaler(img)
@@ -350,12 +495,7 @@ class TestMetricWrapper():
 
         #Show predicted images
         for i, model_folder in enumerate(self.models_folders_paths):
-            model_path = glob.glob(model_folder+'\\*.h5')[0]
-            model = tf.keras.models.load_model(model_path, custom_objects = {'DSSIM':DSSIM,
-                                                                           'PSNR':PSNR
-                                                                           }
-                                               )
-            model_name = model_path.split('\\')[-1][:-3]
+            model_name, model = self.models.get(model_folder)
             #get predicted images
             predicted = model.predict(tf.expand_dims(corr_img,0))
             predicted = predicted[0]
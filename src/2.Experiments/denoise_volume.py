@@ -0,0 +1,150 @@
+""" Command-line inference on whole IXI volumes.
+Every sagittal slice of each .nii.gz is prepared like the training slices (rot90, min-max
+scaling and resize to the model input), reconstructed by a trained autoencoder in batches,
+resampled back to the original size and intensity range and saved as a NIfTI volume with
+the original affine and header.
+
+Slices are streamed from the array proxy batch by batch and volumes are processed one at a
+time, so memory is bounded by one volume plus a few batches whatever the number of volumes.
+
+Usage:
+    python denoise_volume.py results/res_skip_cae/model.h5 "../IXI-T1/*.nii.gz" -o denoised -b 32
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import glob
+import os
+import time
+import nibabel as nib
+import numpy as np
+import tensorflow as tf
+
+SLICE_AXIS = 2 #sagittal axis of the IXI T1 volumes, the one used in slice extraction
+SUFFIX = '_denoised'
+
+
+def volume_batches(proxy, batch_size):
+    """Sagittal slices of a volume, read from its array proxy in batches.
+
+    Yields:
+        [np.ndarray]: float32 batch of slices, slices first and rotated like the extracted
+            slices: k x H x W
+    """
+    n_slices = proxy.shape[SLICE_AXIS]
+    for lo in range(0, n_slices, batch_size):
+        slab = np.asanyarray(proxy[:, :, lo:min(lo+batch_size, n_slices)])
+        yield np.moveaxis(np.rot90(slab, axes=(0,1)), 2, 0).astype(np.float32)
+
+
+def to_volume(slices):
+    """Inverse of the rotation done in volume_batches: k x H x W slices -> volume slab."""
+    return np.rot90(np.moveaxis(slices, 0, 2), k=-1, axes=(0,1))
+
+
+class VolumeDenoiser():
+
+    def __init__(self, model_path, batch_size=32):
+        """
+        Args:
+            model_path (str): .h5 of a trained autoencoder (build_res_skip_cae, build_skcon_cae, ...).
+            batch_size (int, optional): slices per forward pass. Defaults to 32.
+        """
+        #only the forward pass is needed, so the custom losses are not required
+        self.model = tf.keras.models.load_model(model_path, compile=False)
+        self.input_size = tuple(self.model.input_shape[1:3])
+        self.batch_size = batch_size
+
+        @tf.function(input_signature=[tf.TensorSpec([None, None, None], tf.float32)])
+        def reconstruct(slices):
+            size = tf.shape(slices)[1:3]
+            low = tf.reduce_min(slices, axis=[1,2], keepdims=True)
+            high = tf.reduce_max(slices, axis=[1,2], keepdims=True)
+            #empty (constant) slices would divide by zero
+            value_range = tf.where(high > low, high - low, tf.ones_like(high))
+
+            img = tf.expand_dims((slices - low) / value_range, -1)
+            img = tf.image.resize(img, self.input_size)
+            predicted = self.model(img, training=False)
+            predicted = tf.image.resize(predicted, size)[..., 0]
+            return predicted * value_range + low
+
+        self._reconstruct = reconstruct
+
+    def denoise(self, volume_path, save_path):
+        """Reconstruct every sagittal slice of a volume and save it as NIfTI.
+
+        Args:
+            volume_path (str): .nii.gz volume.
+            save_path (str): output .nii.gz.
+
+        Returns:
+            [int]: number of slices reconstructed
+        """
+        img = nib.load(volume_path)
+        output = np.empty(img.shape, dtype=np.float32)
+
+        #the next batch is read from disk while the current one is predicted
+        ds = tf.data.Dataset.from_generator(lambda: volume_batches(img.dataobj, self.batch_size),
+                                            output_types=tf.float32,
+                                            output_shapes=tf.TensorShape([None, None, None]))
+        ds = ds.prefetch(2)
+
+        lo = 0
+        for slices in ds:
+            reconstructed = self._reconstruct(slices).numpy()
+            output[:, :, lo:lo+len(reconstructed)] = to_volume(reconstructed)
+            lo += len(reconstructed)
+
+        header = img.header.copy()
+        header.set_data_dtype(np.float32)
+        nib.save(nib.Nifti1Image(output, img.affine, header), save_path)
+        return lo
+
+
+def output_path(volume_path, save_folder):
+    name = os.path.basename(volume_path)
+    name = name[:-7] if name.endswith('.nii.gz') else os.path.splitext(name)[0]
+    return os.path.join(save_folder, name+SUFFIX+'.nii.gz')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Denoise whole NIfTI volumes with a trained autoencoder.')
+    parser.add_argument('model', help='.h5 of the trained model')
+    parser.add_argument('volumes', nargs='+', help='.nii.gz volumes or glob patterns')
+    parser.add_argument('-o', '--output', default='denoised', help='output folder (default: denoised)')
+    parser.add_argument('-b', '--batch-size', type=int, default=32, help='slices per forward pass (default: 32)')
+    parser.add_argument('--overwrite', action='store_true', help='process volumes already in the output folder')
+    args = parser.parse_args()
+
+    volume_files = sorted(set(f for pattern in args.volumes for f in glob.glob(pattern)))
+    if not volume_files:
+        raise Exception('No volumes found in '+str(args.volumes))
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+
+    denoiser = VolumeDenoiser(args.model, batch_size=args.batch_size)
+    total_slices, total_time = 0, 0.
+    for f in volume_files:
+        save_path = output_path(f, args.output)
+        if os.path.isfile(save_path) and not args.overwrite:
+            print(os.path.basename(f), '- already denoised')
+            continue
+        start = time.perf_counter()
+        n_slices = denoiser.denoise(f, save_path)
+        elapsed = time.perf_counter()-start
+        total_slices += n_slices
+        total_time += elapsed
+        print('{} - {} slices in {:.2f} s - {:.1f} slices/s'.format(os.path.basename(f), n_slices,
+                                                                   elapsed, n_slices/elapsed))
+
+    if total_slices:
+        print('Total: {} slices in {:.2f} s - {:.1f} slices/s'.format(total_slices, total_time,
+                                                                    total_slices/total_time))
+
+
+if __name__ == "__main__":
+    main()
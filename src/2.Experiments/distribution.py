@@ -0,0 +1,60 @@
+""" Distribution strategies for residual_cae_experiment.py.
+
+    None: default strategy, one device.
+    'mirrored': MirroredStrategy, synchronous data parallelism over the local GPUs (or CPU).
+    'multi_worker': MultiWorkerMirroredStrategy over the processes described by TF_CONFIG,
+        e.g. several CPU processes on localhost started by launch_local_workers.py.
+
+Worker 0 is the chief: it is the only one writing results, the others write to a
+temporary folder that is deleted at the end.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import json
+import os
+import tensorflow as tf
+
+DISTRIBUTION_OPTIONS = [None, 'mirrored', 'multi_worker']
+
+
+def cluster_info():
+    """Number of workers and index of this one, from TF_CONFIG.
+
+    Returns:
+        [tuple]: (num_workers, worker_index), (1, 0) without TF_CONFIG
+    """
+    tf_config = json.loads(os.environ.get('TF_CONFIG', '{}'))
+    workers = tf_config.get('cluster', {}).get('worker', [])
+    if not workers:
+        return 1, 0
+    return len(workers), int(tf_config.get('task', {}).get('index', 0))
+
+
+def is_chief():
+    return cluster_info()[1] == 0
+
+
+def get_strategy(distribution=None):
+    """tf.distribute strategy of a distribution option. TF_CONFIG with several workers selects
+    'multi_worker' when distribution is None. Must be called before any other TensorFlow op.
+
+    Args:
+        distribution (str, optional): one of DISTRIBUTION_OPTIONS. Defaults to None.
+
+    Returns:
+        [tuple]: (strategy, distribution option used)
+    """
+    assert distribution in DISTRIBUTION_OPTIONS, 'Distribution does not belong to the possible ones'
+    if distribution is None and cluster_info()[0] > 1:
+        distribution = 'multi_worker'
+
+    if distribution == 'mirrored':
+        return tf.distribute.MirroredStrategy(), distribution
+    if distribution == 'multi_worker':
+        if hasattr(tf.distribute, 'MultiWorkerMirroredStrategy'):
+            return tf.distribute.MultiWorkerMirroredStrategy(), distribution
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy(), distribution #TF<2.4
+    return tf.distribute.get_strategy(), distribution
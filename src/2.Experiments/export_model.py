@@ -0,0 +1,420 @@
+""" Export of the trained autoencoders to inference-only graphs.
+
+The Keras model is rewritten without the training-only pieces:
+    - BatchNormalization right after a Conv2D/Conv2DTranspose (with no activation and no
+      other consumer) is folded into the kernel and bias of the convolution.
+    - Dropout/SpatialDropout2D layers (build_myronenko_cae) are removed.
+    - Kernel regularizers are dropped.
+The other BatchNormalization layers (pre-activation ones, after an Add or an Input) are kept,
+in inference they are a per-channel affine transform.
+
+The result is exported as SavedModel, TFLite and, if tf2onnx is installed, ONNX, and the
+'bench' command compares CPU latency and memory of each format against the .h5 for every
+architecture builder.
+
+Usage:
+    python export_model.py export results/res_skip_cae/model.h5 -o exported
+    python export_model.py bench
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+try:
+    import tf2onnx
+except ImportError:
+    tf2onnx = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+CONV_LAYERS = ['Conv2D', 'Conv2DTranspose']
+DROPOUT_LAYERS = ['Dropout', 'SpatialDropout1D', 'SpatialDropout2D', 'SpatialDropout3D', 'GaussianNoise', 'GaussianDropout']
+EXPORT_FORMATS = ['saved_model', 'tflite', 'onnx']
+INPUT_SHAPE = (128,128,1)
+BENCH_BATCH_SIZE = 8
+BENCH_RUNS = 50
+
+
+def _inbound_names(obj):
+    """Names of the layers referenced in the inbound_nodes of a layer config.
+    Handles both the list ([name, node, tensor, kwargs]) and the keras_history formats."""
+    names = []
+    if isinstance(obj, dict):
+        if 'keras_history' in obj:
+            names.append(obj['keras_history'][0])
+        else:
+            for value in obj.values():
+                names.extend(_inbound_names(value))
+    elif isinstance(obj, (list, tuple)):
+        if len(obj) in (3, 4) and isinstance(obj[0], str) and isinstance(obj[1], int):
+            names.append(obj[0])
+        else:
+            for value in obj:
+                names.extend(_inbound_names(value))
+    return names
+
+
+def _rename_inbound(obj, renames):
+    """Copy of the inbound_nodes of a layer config with the references to renames keys
+    pointing to their values."""
+    if isinstance(obj, dict):
+        if 'keras_history' in obj:
+            history = list(obj['keras_history'])
+            history[0] = renames.get(history[0], history[0])
+            return dict(obj, keras_history=history)
+        return {k: _rename_inbound(v, renames) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        if len(obj) in (3, 4) and isinstance(obj[0], str) and isinstance(obj[1], int):
+            return [renames.get(obj[0], obj[0])] + list(obj[1:])
+        return [_rename_inbound(v, renames) for v in obj]
+    return obj
+
+
+def _follow(name, renames):
+    while name in renames:
+        name = renames[name]
+    return name
+
+
+def fold_bn_weights(conv_weights, bn_weights, conv_class, bn_config):
+    """Kernel and bias of a convolution followed by a BatchNormalization in inference mode.
+
+    Args:
+        conv_weights (list): [kernel] or [kernel, bias] of the convolution.
+        bn_weights (list): [gamma, beta, moving_mean, moving_variance], without gamma if
+            scale=False and without beta if center=False.
+        conv_class (str): 'Conv2D' (kernel h x w x in x out) or 'Conv2DTranspose' (h x w x out x in).
+        bn_config (dict): config of the BatchNormalization.
+
+    Returns:
+        [list]: [kernel, bias]
+    """
+    kernel = conv_weights[0]
+    n_out = kernel.shape[3] if conv_class == 'Conv2D' else kernel.shape[2]
+    bias = conv_weights[1] if len(conv_weights) > 1 else np.zeros(n_out, dtype=kernel.dtype)
+
+    bn_weights = list(bn_weights)
+    gamma = bn_weights.pop(0) if bn_config.get('scale', True) else np.ones(n_out, dtype=kernel.dtype)
+    beta = bn_weights.pop(0) if bn_config.get('center', True) else np.zeros(n_out, dtype=kernel.dtype)
+    mean, variance = bn_weights
+
+    scale = gamma / np.sqrt(variance + bn_config.get('epsilon', 1e-3))
+    if conv_class == 'Conv2D':
+        kernel = kernel * scale
+    else:
+        kernel = kernel * scale[:, np.newaxis]
+    bias = (bias - mean) * scale + beta
+    return [kernel.astype(conv_weights[0].dtype), bias.astype(conv_weights[0].dtype)]
+
+
+def inference_model(model):
+    """Copy of a functional model without its training-only layers (see module docstring).
+
+    Args:
+        model (tf.keras.Model): trained model.
+
+    Returns:
+        [tuple]: (inference tf.keras.Model, dict of folded layers: BN name -> conv name,
+            list of removed dropout layers)
+    """
+    config = model.get_config()
+    layers = {layer['config']['name']: layer for layer in config['layers']}
+    consumers = dict()
+    for layer in config['layers']:
+        for inbound in set(_inbound_names(layer['inbound_nodes'])):
+            consumers.setdefault(inbound, []).append(layer['config']['name'])
+    output_names = set(_inbound_names(config['output_layers']))
+
+    renames, folded, removed = dict(), dict(), []
+    for layer in config['layers']:
+        name = layer['config']['name']
+        inbound = _inbound_names(layer['inbound_nodes'])
+        if layer['class_name'] in DROPOUT_LAYERS and len(inbound) == 1:
+            renames[name] = inbound[0]
+            removed.append(name)
+        elif layer['class_name'] == 'BatchNormalization' and len(inbound) == 1:
+            source_name = _follow(inbound[0], renames)
+            source = layers[source_name]
+            axis = layer['config'].get('axis', -1)
+            axis = axis[0] if isinstance(axis, (list, tuple)) and len(axis) == 1 else axis
+            if (source['class_name'] in CONV_LAYERS and
+                source['config'].get('activation', 'linear') == 'linear' and
+                len(consumers[inbound[0]]) == 1 and len(consumers[source_name]) == 1 and
+                source_name not in output_names and
+                axis in (-1, 3)):
+                renames[name] = source_name
+                folded[name] = source_name
+
+    new_layers = []
+    for layer in config['layers']:
+        name = layer['config']['name']
+        if name in renames:
+            continue
+        layer = dict(layer, config=dict(layer['config']))
+        if name in folded.values():
+            layer['config']['use_bias'] = True
+        for key in ['kernel_regularizer', 'bias_regularizer', 'activity_regularizer']:
+            if key in layer['config']:
+                layer['config'][key] = None
+        layer['inbound_nodes'] = _rename_inbound(layer['inbound_nodes'],
+                                                 {k: _follow(k, renames) for k in renames})
+        new_layers.append(layer)
+
+    config = dict(config, layers=new_layers,
+                  output_layers=_rename_inbound(config['output_layers'], {k: _follow(k, renames) for k in renames}))
+    exported = tf.keras.Model.from_config(config)
+
+    conv_to_bn = {conv: bn for bn, conv in folded.items()}
+    for layer in exported.layers:
+        weights = model.get_layer(layer.name).get_weights()
+        if layer.name in conv_to_bn:
+            bn = model.get_layer(conv_to_bn[layer.name])
+            weights = fold_bn_weights(weights, bn.get_weights(), layer.__class__.__name__, bn.get_config())
+        layer.set_weights(weights)
+    return exported, folded, removed
+
+
+def _serving_module(model):
+    module = tf.Module()
+    module.model = model
+    module.serve = tf.function(lambda x: model(x, training=False),
+                               input_signature=[tf.TensorSpec([None]+list(model.input_shape[1:]), tf.float32)])
+    return module
+
+
+def export(model, export_dir, formats=EXPORT_FORMATS):
+    """Save an inference model in several formats.
+
+    Args:
+        model (tf.keras.Model): inference model, see inference_model.
+        export_dir (str): output folder.
+        formats (list, optional): some of EXPORT_FORMATS. ONNX is skipped if tf2onnx is not
+            installed. Defaults to EXPORT_FORMATS.
+
+    Returns:
+        [dict]: format -> path of the exported artifact
+    """
+    if not os.path.exists(export_dir):
+        os.makedirs(export_dir)
+    paths = dict()
+    saved_model_path = os.path.join(export_dir, 'saved_model')
+    if 'saved_model' in formats or 'tflite' in formats:
+        module = _serving_module(model)
+        tf.saved_model.save(module, saved_model_path, signatures={'serving_default': module.serve})
+        if 'saved_model' in formats:
+            paths['saved_model'] = saved_model_path
+
+    if 'tflite' in formats:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        paths['tflite'] = os.path.join(export_dir, 'model.tflite')
+        with open(paths['tflite'], 'wb') as f:
+            f.write(converter.convert())
+
+    if 'onnx' in formats:
+        if tf2onnx is None:
+            print('tf2onnx not installed, ONNX export skipped')
+        else:
+            paths['onnx'] = os.path.join(export_dir, 'model.onnx')
+            signature = [tf.TensorSpec([None]+list(model.input_shape[1:]), tf.float32, name='input')]
+            tf2onnx.convert.from_keras(model, input_signature=signature, output_path=paths['onnx'])
+    return paths
+
+
+def artifact_kind(path):
+    """'h5', 'tflite', 'onnx' or 'saved_model' (folder), from the path of an artifact."""
+    if os.path.isdir(path):
+        return 'saved_model'
+    return os.path.splitext(path)[1][1:]
+
+
+def load_predictor(kind, path):
+    """Batch -> reconstruction function for a saved artifact.
+
+    Args:
+        kind (str): 'h5' or one of EXPORT_FORMATS.
+        path (str): artifact path.
+    """
+    if kind == 'h5':
+        model = tf.keras.models.load_model(path, compile=False)
+        predict = tf.function(lambda x: model(x, training=False))
+        return lambda x: predict(x).numpy()
+    if kind == 'saved_model':
+        serve = tf.saved_model.load(path).signatures['serving_default']
+        return lambda x: list(serve(tf.constant(x)).values())[0].numpy()
+    if kind == 'tflite':
+        interpreter = tf.lite.Interpreter(model_path=path, num_threads=os.cpu_count())
+        input_index = interpreter.get_input_details()[0]['index']
+        output_index = interpreter.get_output_details()[0]['index']
+        def predict(x):
+            if tuple(interpreter.get_input_details()[0]['shape']) != x.shape:
+                interpreter.resize_tensor_input(input_index, x.shape)
+                interpreter.allocate_tensors()
+            interpreter.set_tensor(input_index, x)
+            interpreter.invoke()
+            return interpreter.get_tensor(output_index)
+        interpreter.allocate_tensors()
+        return predict
+    if kind == 'onnx':
+        import onnxruntime
+        session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        input_name = session.get_inputs()[0].name
+        return lambda x: session.run(None, {input_name: x})[0]
+    raise Exception('Unknown artifact type '+kind)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, None if it cannot be measured.
+    ru_maxrss is not used because it survives the exec of spawned processes."""
+    if os.path.isfile('/proc/self/status'):
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    if psutil is not None:
+        info = psutil.Process().memory_info()
+        return getattr(info, 'peak_wset', info.rss) / 2**20 #peak_wset only on Windows
+    return None
+
+
+def _benchmark_artifact(name, path, batch_size, runs):
+    """Run in a fresh process so its memory only accounts for one artifact."""
+    tf.config.set_visible_devices([], 'GPU')
+    base_rss = peak_rss_mb()
+    start = time.perf_counter()
+    predict = load_predictor(artifact_kind(path), path)
+    x = np.random.default_rng(0).random((batch_size,)+INPUT_SHAPE, dtype=np.float32)
+    output = predict(x) #warm up / tracing
+    load_time = time.perf_counter()-start
+
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        predict(x)
+        times.append(time.perf_counter()-start)
+    times = np.array(times) * 1000
+    rss = peak_rss_mb()
+    return {'format': name,
+            'load_s': load_time,
+            'latency_p50_ms': float(np.percentile(times, 50)),
+            'latency_p99_ms': float(np.percentile(times, 99)),
+            'slices_s': batch_size / np.mean(times) * 1000,
+            'peak_rss_mb': rss,
+            'rss_over_tf_mb': rss - base_rss if rss is not None else None,
+            'size_mb': _size_mb(path),
+            'output': output}
+
+
+def _size_mb(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files) / 2**20
+    return os.path.getsize(path) / 2**20
+
+
+def benchmark_artifacts(artifacts, batch_size=BENCH_BATCH_SIZE, runs=BENCH_RUNS):
+    """CPU latency and memory of several artifacts of the same model, each in its own process.
+
+    Args:
+        artifacts (dict): name -> path of a .h5, .tflite, .onnx or SavedModel folder. The first
+            one is the reference output for the max abs difference.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for name, path in artifacts.items():
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_benchmark_artifact, (name, path, batch_size, runs)))
+    reference = results[0]['output']
+    for r in results:
+        r['max_abs_diff'] = float(np.max(np.abs(r.pop('output') - reference)))
+    return results
+
+
+def builders():
+    """One model per architecture option of residual_cae_experiment.py, with random weights."""
+    from residual_cae import build_res_encoder
+    from residual_cae_myronenko import build_myronenko_cae
+    from skip_connection_cae import build_skcon_cae
+    from res_skip_cae import build_res_skip_cae
+    return {'small_res_cae': lambda: build_res_encoder(INPUT_SHAPE),
+            'myronenko_cae': lambda: build_myronenko_cae(INPUT_SHAPE),
+            'skip_con_cae': lambda: build_skcon_cae(INPUT_SHAPE),
+            'res_skip_cae': lambda: build_res_skip_cae(INPUT_SHAPE)}
+
+
+def _randomize_bn_statistics(model, seed=0):
+    """Non trivial moving statistics, so folding untrained models is really checked."""
+    rng = np.random.default_rng(seed)
+    for layer in model.layers:
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            layer.set_weights([rng.uniform(0.5, 1.5, w.shape).astype(w.dtype) if i != len(layer.weights)-2
+                               else rng.normal(0, 0.1, w.shape).astype(w.dtype)
+                               for i, w in enumerate(layer.get_weights())])
+
+
+def export_h5(model_path, export_dir, formats=EXPORT_FORMATS):
+    model = tf.keras.models.load_model(model_path, compile=False)
+    exported, folded, removed = inference_model(model)
+    print('{}: {} BatchNormalization folded, {} dropout layers removed, {} -> {} layers'.format(
+          os.path.basename(model_path), len(folded), len(removed), len(model.layers), len(exported.layers)))
+    x = np.random.default_rng(0).random((BENCH_BATCH_SIZE,)+tuple(model.input_shape[1:]), dtype=np.float32)
+    print('Max abs difference with the .h5: {:.2e}'.format(
+          float(np.max(np.abs(model(x, training=False).numpy() - exported(x, training=False).numpy())))))
+    return export(exported, export_dir, formats)
+
+
+def benchmark_builders(batch_size=BENCH_BATCH_SIZE, runs=BENCH_RUNS):
+    for name, build in builders().items():
+        with tempfile.TemporaryDirectory() as tmp:
+            model = build()
+            _randomize_bn_statistics(model)
+            h5_path = os.path.join(tmp, name+'.h5')
+            model.save(h5_path)
+            artifacts = {'h5': h5_path}
+            artifacts.update(export_h5(h5_path, os.path.join(tmp, 'exported')))
+            print(name)
+            for r in benchmark_artifacts(artifacts, batch_size, runs):
+                print('  {format:<12} p50 {latency_p50_ms:8.2f} ms  p99 {latency_p99_ms:8.2f} ms  '
+                      '{slices_s:8.1f} slices/s  load {load_s:6.2f} s  size {size_mb:7.2f} MB  '
+                      'rss {peak_rss_mb:7.1f} MB (+{rss_over_tf_mb:6.1f})  max|diff| {max_abs_diff:.1e}'.format(**r))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export trained autoencoders to inference graphs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export', help='export a trained .h5')
+    export_parser.add_argument('model', help='.h5 of the trained model')
+    export_parser.add_argument('-o', '--output', default='exported')
+    export_parser.add_argument('-f', '--formats', nargs='+', default=EXPORT_FORMATS, choices=EXPORT_FORMATS)
+    export_parser.add_argument('--bench', action='store_true', help='compare the exported artifacts with the .h5')
+
+    bench_parser = subparsers.add_parser('bench', help='export and benchmark every architecture builder')
+    bench_parser.add_argument('-b', '--batch-size', type=int, default=BENCH_BATCH_SIZE)
+    bench_parser.add_argument('-r', '--runs', type=int, default=BENCH_RUNS)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        paths = export_h5(args.model, args.output, args.formats)
+        print(json.dumps(paths, indent=1))
+        if args.bench:
+            artifacts = {'h5': args.model}
+            artifacts.update(paths)
+            for r in benchmark_artifacts(artifacts):
+                print(r)
+    else:
+        benchmark_builders(args.batch_size, args.runs)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,304 @@
+""" Local HTTP inference server with dynamic batching.
+Slices posted by the clients are queued and a single worker thread groups them in batches
+of up to max_batch_size slices, waiting at most max_wait_ms since the first queued slice,
+so the model runs on full batches under load and still answers quickly when idle.
+
+Endpoints:
+    POST /reconstruct  body: .npy of one slice (H x W or H x W x 1) or a batch (N x H x W [x 1]).
+                       Slices are min-max scaled and resized to the model input like the
+                       training slices. Returns the .npy of the reconstruction (N x h x w x 1).
+    GET  /metrics      json with request and slice counts, throughput, mean batch size and
+                       p50/p99 latency (ms) over the last requests.
+
+Usage:
+    python inference_server.py serve results/res_skip_cae/model.h5 --port 8500 --cpu
+    python inference_server.py bench --url http://localhost:8500 --requests 2000 --concurrency 16
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import io
+import json
+import queue
+import threading
+import time
+import urllib.request
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+
+MAX_BATCH_SIZE = 32
+MAX_WAIT_MS = 10
+LATENCY_WINDOW = 10000 #requests kept for the latency percentiles
+
+
+def to_npy_bytes(array):
+    buffer = io.BytesIO()
+    np.save(buffer, array, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def from_npy_bytes(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+class _Request():
+    """Slices of one request and the event its handler waits on."""
+
+    def __init__(self, slices):
+        self.slices = slices
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class DynamicBatcher():
+
+    def __init__(self, model, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        """
+        Args:
+            model (tf.keras.Model): trained autoencoder, e.g. res_skip_cae.build_res_skip_cae.
+            max_batch_size (int, optional): maximum slices per forward pass. Defaults to MAX_BATCH_SIZE.
+            max_wait_ms (float, optional): maximum time the first slice of a batch waits for others.
+                Defaults to MAX_WAIT_MS.
+        """
+        self.model = model
+        self.input_size = tuple(model.input_shape[1:3])
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.queue = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._n_requests = 0
+        self._n_slices = 0
+        self._n_batches = 0
+        self._start = time.perf_counter()
+
+        @tf.function(input_signature=[tf.TensorSpec([None, None, None, 1], tf.float32)])
+        def predict(batch):
+            return self.model(batch, training=False)
+        self._predict = predict
+
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def preprocess(self, slices):
+        """Min-max scaling per slice and resize to the model input: N x h x w x 1 float32."""
+        slices = np.asarray(slices, dtype=np.float32)
+        if slices.ndim == 2 or (slices.ndim == 3 and slices.shape[-1] == 1):
+            slices = slices[np.newaxis]
+        if slices.ndim == 3:
+            slices = slices[..., np.newaxis]
+        if slices.ndim != 4 or slices.shape[-1] != 1:
+            raise Exception('Expected one grayscale slice or a batch of them, got shape '+str(slices.shape))
+
+        low = slices.min(axis=(1,2,3), keepdims=True)
+        value_range = slices.max(axis=(1,2,3), keepdims=True) - low
+        slices = (slices - low) / np.where(value_range > 0, value_range, 1)
+        if slices.shape[1:3] != self.input_size:
+            slices = tf.image.resize(slices, self.input_size).numpy()
+        return slices
+
+    def submit(self, slices, timeout=None):
+        """Queue slices and wait for their reconstruction (called from the handler threads)."""
+        start = time.perf_counter()
+        request = _Request(self.preprocess(slices))
+        self.queue.put(request)
+        if not request.done.wait(timeout):
+            raise Exception('Inference timed out')
+        if request.error is not None:
+            raise request.error
+        with self._lock:
+            self._latencies.append(time.perf_counter()-start)
+            self._n_requests += 1
+            self._n_slices += len(request.slices)
+        return request.result
+
+    def _next_batch(self):
+        """Block for the first request, then gather more until the batch is full or the deadline."""
+        requests = [self.queue.get()]
+        if requests[0] is None: #stop sentinel
+            return []
+        n = len(requests[0].slices)
+        deadline = time.perf_counter() + self.max_wait
+        while n < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                request = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if request is None:
+                self._stop.set()
+                break
+            requests.append(request)
+            n += len(request.slices)
+        return requests
+
+    def _run(self):
+        while not self._stop.is_set():
+            requests = self._next_batch()
+            if not requests:
+                break
+            try:
+                batch = np.concatenate([r.slices for r in requests])
+                #a request larger than max_batch_size is still run in chunks of that size
+                predicted = np.concatenate([self._predict(batch[i:i+self.max_batch_size]).numpy()
+                                            for i in range(0, len(batch), self.max_batch_size)])
+                i = 0
+                for r in requests:
+                    r.result = predicted[i:i+len(r.slices)]
+                    i += len(r.slices)
+            except Exception as e:
+                for r in requests:
+                    r.error = e
+            with self._lock:
+                self._n_batches += 1
+            for r in requests:
+                r.done.set()
+
+    def metrics(self):
+        with self._lock:
+            latencies = np.array(self._latencies) * 1000
+            elapsed = time.perf_counter() - self._start
+            return {'requests': self._n_requests,
+                    'slices': self._n_slices,
+                    'batches': self._n_batches,
+                    'mean_batch_size': self._n_slices / self._n_batches if self._n_batches else 0.,
+                    'throughput_slices_s': self._n_slices / elapsed,
+                    'throughput_requests_s': self._n_requests / elapsed,
+                    'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                    'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None}
+
+    def reset_metrics(self):
+        with self._lock:
+            self._latencies.clear()
+            self._n_requests = self._n_slices = self._n_batches = 0
+            self._start = time.perf_counter()
+
+    def close(self):
+        self._stop.set()
+        self.queue.put(None)
+        self._worker.join()
+
+
+def make_handler(batcher):
+
+    class InferenceHandler(BaseHTTPRequestHandler):
+
+        def _send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_json(self, code, content):
+            self._send(code, json.dumps(content).encode(), 'application/json')
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self._send_json(200, batcher.metrics())
+            else:
+                self._send_json(404, {'error': 'Unknown path '+self.path})
+
+        def do_POST(self):
+            if self.path == '/metrics/reset':
+                batcher.reset_metrics()
+                return self._send_json(200, batcher.metrics())
+            if self.path != '/reconstruct':
+                return self._send_json(404, {'error': 'Unknown path '+self.path})
+            try:
+                slices = from_npy_bytes(self.rfile.read(int(self.headers['Content-Length'])))
+                result = batcher.submit(slices)
+            except Exception as e:
+                return self._send_json(400, {'error': str(e)})
+            self._send(200, to_npy_bytes(result), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass #one line per request would dominate the latency
+
+    return InferenceHandler
+
+
+def serve(model_path, host='localhost', port=8500, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS, cpu=False):
+    if cpu:
+        tf.config.set_visible_devices([], 'GPU')
+    model = tf.keras.models.load_model(model_path, compile=False)
+    batcher = DynamicBatcher(model, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    #warm up, so the first client does not pay the tracing of the model
+    batcher.submit(np.zeros(batcher.input_size, dtype=np.float32))
+    batcher.reset_metrics()
+
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print('Serving', model_path, 'on http://{}:{}'.format(host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
+
+
+def benchmark(url, n_requests=1000, concurrency=16, slice_shape=(256,256), seed=None):
+    """Local client: post n_requests random slices from concurrency threads and report latency
+    and throughput measured by the client and by the server."""
+    rng = np.random.default_rng(seed)
+    payloads = [to_npy_bytes(rng.random(slice_shape, dtype=np.float32)) for _ in range(min(n_requests, 64))]
+
+    def post(i):
+        start = time.perf_counter()
+        request = urllib.request.Request(url+'/reconstruct', data=payloads[i % len(payloads)],
+                                         headers={'Content-Type': 'application/octet-stream'})
+        with urllib.request.urlopen(request) as response:
+            from_npy_bytes(response.read())
+        return time.perf_counter()-start
+
+    urllib.request.urlopen(urllib.request.Request(url+'/metrics/reset', data=b'')).read()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = np.array(list(pool.map(post, range(n_requests)))) * 1000
+    elapsed = time.perf_counter()-start
+
+    print('Client: {} requests, concurrency {} - {:.1f} slices/s - p50 {:.2f} ms - p99 {:.2f} ms'.format(
+          n_requests, concurrency, n_requests/elapsed, np.percentile(latencies, 50), np.percentile(latencies, 99)))
+    with urllib.request.urlopen(url+'/metrics') as response:
+        print('Server:', json.loads(response.read()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Autoencoder inference server with dynamic batching.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='serve a trained model')
+    serve_parser.add_argument('model', help='.h5 of the trained model')
+    serve_parser.add_argument('--host', default='localhost')
+    serve_parser.add_argument('--port', type=int, default=8500)
+    serve_parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    serve_parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS)
+    serve_parser.add_argument('--cpu', action='store_true', help='hide the GPUs')
+
+    bench_parser = subparsers.add_parser('bench', help='load test a running server')
+    bench_parser.add_argument('--url', default='http://localhost:8500')
+    bench_parser.add_argument('--requests', type=int, default=1000)
+    bench_parser.add_argument('--concurrency', type=int, default=16)
+    bench_parser.add_argument('--slice-size', type=int, nargs=2, default=(256,256))
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.model, args.host, args.port, args.max_batch_size, args.max_wait_ms, args.cpu)
+    else:
+        benchmark(args.url, args.requests, args.concurrency, tuple(args.slice_size))
+
+
+if __name__ == "__main__":
+    main()
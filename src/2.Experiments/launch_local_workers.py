@@ -0,0 +1,80 @@
+""" Start a multi-worker training on this machine: one process per worker, each with the
+TF_CONFIG of a localhost cluster, so residual_cae_experiment.py selects MultiWorkerMirroredStrategy.
+Worker 0 (chief) prints to the console, the others log to log_dir/worker_<i>.log.
+
+Usage:
+    python launch_local_workers.py --workers 4 --cpu
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+BASE_PORT = 20000
+
+
+def tf_config(n_workers, index, base_port=BASE_PORT):
+    return json.dumps({'cluster': {'worker': ['localhost:'+str(base_port+i) for i in range(n_workers)]},
+                       'task': {'type': 'worker', 'index': index}})
+
+
+def launch(script, n_workers, base_port=BASE_PORT, cpu=False, log_dir='worker_logs', script_args=()):
+    """Run the workers and wait for them. If one fails, the others are stopped.
+
+    Returns:
+        [int]: exit code, 0 if every worker succeeded
+    """
+    os.makedirs(log_dir, exist_ok=True)
+    processes, logs = [], []
+    for i in range(n_workers):
+        env = dict(os.environ, TF_CONFIG=tf_config(n_workers, i, base_port))
+        if cpu:
+            env['CUDA_VISIBLE_DEVICES'] = '-1'
+        if i == 0:
+            stdout = None
+        else:
+            stdout = open(os.path.join(log_dir, 'worker_'+str(i)+'.log'), 'w')
+            logs.append(stdout)
+        processes.append(subprocess.Popen([sys.executable, script]+list(script_args), env=env,
+                                          stdout=stdout, stderr=subprocess.STDOUT if stdout else None))
+
+    exit_code = 0
+    try:
+        while any(p.poll() is None for p in processes):
+            failed = [i for i, p in enumerate(processes) if p.poll() not in (None, 0)]
+            if failed:
+                print('Worker', failed[0], 'failed with exit code', processes[failed[0]].returncode, '- stopping the others')
+                exit_code = processes[failed[0]].returncode
+                break
+            time.sleep(1)
+    finally:
+        for p in processes:
+            if p.poll() is None:
+                p.terminate()
+        for p in processes:
+            p.wait()
+        for log in logs:
+            log.close()
+    return exit_code or next((p.returncode for p in processes if p.returncode), 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Multi-worker training on localhost.')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--script', default='residual_cae_experiment.py')
+    parser.add_argument('--port', type=int, default=BASE_PORT, help='port of worker 0, the others follow')
+    parser.add_argument('--cpu', action='store_true', help='hide the GPUs from the workers')
+    parser.add_argument('--log-dir', default='worker_logs')
+    args, script_args = parser.parse_known_args()
+    sys.exit(launch(args.script, args.workers, args.port, args.cpu, args.log_dir, script_args))
+
+
+if __name__ == "__main__":
+    main()
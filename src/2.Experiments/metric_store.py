@@ -0,0 +1,176 @@
+""" Per-image test metrics of every model, persisted in a columnar (Parquet) store.
+The store is keyed by (test set, model): every test set (a hash of its sorted file list) is a
+folder with one file per model, with the columns FILE, MODEL, MSE, DSSIM, PSNR and WEIGHTS
+(hash of the evaluated .h5, so the metrics of a model retrained under the same name are not
+reused). Evaluating a new model only appends its file, evaluating a model on another test set (e.g. the quantization
+subset of quantize_model.py) does not replace its other evaluations, and the statistical
+comparisons (e.g. 5.T-Test-PostHocComparison.ipynb) read the columns they need without running any model.
+Parquet needs pyarrow (or fastparquet) installed along pandas.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import glob
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+METRICS = ['mse', 'dssim', 'psnr']
+TEST_SET_PREFIX = 'test_'
+
+
+def test_set_key(files):
+    """Key of a test set, independent of the order its files are listed in."""
+    return hashlib.sha1(json.dumps(sorted(files)).encode()).hexdigest()[:16]
+
+
+def weights_key(model_path, chunk_size=1<<20):
+    """Key of the weights of a model: hash of the content of its file."""
+    sha1 = hashlib.sha1()
+    with open(model_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()[:16]
+
+
+class MetricStore():
+    """Per-image, per-model metric table keyed by (test set, FILE, MODEL)."""
+
+    def __init__(self, store_path):
+        """
+        Args:
+            store_path (str): folder of the store, created if it does not exist.
+        """
+        self.store_path = store_path
+        if not os.path.exists(store_path):
+            os.makedirs(store_path)
+
+    def test_set_path(self, files):
+        return os.path.join(self.store_path, TEST_SET_PREFIX+test_set_key(files))
+
+    def model_file(self, model_name, files):
+        return os.path.join(self.test_set_path(files), model_name+'.parquet')
+
+    def _model_files(self, model_name, files=None):
+        """Stored files of a model: the one of a test set, or the ones of every test set."""
+        if files is not None:
+            path = self.model_file(model_name, files)
+            return [path] if os.path.isfile(path) else []
+        return sorted(glob.glob(os.path.join(self.store_path, TEST_SET_PREFIX+'*', model_name+'.parquet')))
+
+    def models(self, files=None):
+        """Names of the models in the store, or of the models evaluated on a test set."""
+        folder = self.test_set_path(files) if files is not None else os.path.join(self.store_path, TEST_SET_PREFIX+'*')
+        return sorted(set(os.path.basename(f)[:-len('.parquet')]
+                          for f in glob.glob(os.path.join(folder, '*.parquet'))))
+
+    def has_model(self, model_name, files, weights=None):
+        """Whether a model is stored for exactly these test files.
+
+        Args:
+            model_name (str): name of the model.
+            files (list): test files.
+            weights (str, optional): weights_key of the model file. A model stored with other
+                weights (retrained under the same name) is not. Defaults to None, any weights.
+        """
+        path = self.model_file(model_name, files)
+        if not os.path.isfile(path):
+            return False
+        if weights is None:
+            return True
+        stored = pd.read_parquet(path)
+        return 'WEIGHTS' in stored and bool((stored['WEIGHTS'] == weights).all())
+
+    def append(self, model_name, files, metrics, weights=None):
+        """Store the per-image metrics of a model on a test set, replacing only a previous
+        evaluation of the same model on the same test set.
+
+        Args:
+            model_name (str): name of the model.
+            files (list): test files, in the order of the metric values.
+            metrics (dict): {'mse', 'dssim', 'psnr'} with one value per file.
+            weights (str, optional): weights_key of the evaluated model file. Defaults to None,
+                a model without a file (e.g. a predictor function).
+        """
+        df = pd.DataFrame({'FILE': list(files), 'MODEL': model_name})
+        for m in METRICS:
+            values = np.asarray(metrics[m], dtype=np.float32)
+            assert len(values) == len(df), 'One '+m+' value per test file is needed'
+            df[m.upper()] = values
+        df['WEIGHTS'] = weights or ''
+        os.makedirs(self.test_set_path(files), exist_ok=True)
+        #write aside and rename, so an interrupted run never leaves a half written model
+        path = self.model_file(model_name, files)
+        df.to_parquet(path+'.tmp', index=False)
+        os.replace(path+'.tmp', path)
+
+    def load(self, model_names=None, columns=None, files=None):
+        """Long table of the stored metrics.
+
+        Args:
+            model_names (list, optional): models to read. Defaults to None, every stored model
+                (of the test set, if files is given).
+            columns (list, optional): columns to read, e.g. ['FILE', 'MODEL', 'PSNR'].
+                Defaults to None, all of them.
+            files (list, optional): test set to read. The rows of every model are returned in
+                this order (the stored order depends on how the files were listed when evaluated).
+                Defaults to None, every test set in stored order, with a TEST_SET column.
+
+        Returns:
+            [DataFrame]: one row per (test file, model), and test set if files is None
+        """
+        model_names = self.models(files) if model_names is None else model_names
+        if files is not None and columns is not None and 'FILE' not in columns:
+            columns = ['FILE'] + list(columns)
+        frames = []
+        for name in model_names:
+            paths = self._model_files(name, files)
+            if files is not None and not paths:
+                raise Exception('Model '+name+' is not stored for the requested test files')
+            for path in paths:
+                df = pd.read_parquet(path, columns=columns)
+                if files is not None:
+                    df = df.set_index('FILE').reindex(list(files)).reset_index()
+                else:
+                    df['TEST_SET'] = os.path.basename(os.path.dirname(path))[len(TEST_SET_PREFIX):]
+                frames.append(df)
+        if not frames:
+            return pd.DataFrame(columns=['FILE', 'MODEL'] + [m.upper() for m in METRICS])
+        return pd.concat(frames, ignore_index=True)
+
+    def _single_test_set(self, df):
+        if 'TEST_SET' in df and df.groupby('MODEL')['TEST_SET'].nunique().max() > 1:
+            raise Exception('Models stored for several test sets, pass the test files to choose one')
+
+    def metric_table(self, metric, model_names=None, files=None):
+        """Wide table of one metric: a row per test file and a column per model, paired for t-tests."""
+        df = self.load(model_names, columns=['FILE', 'MODEL', metric.upper()], files=files)
+        self._single_test_set(df)
+        return df.pivot(index='FILE', columns='MODEL', values=metric.upper())
+
+    def individual_metrics(self, model_names=None, files=None):
+        """Stored metrics in the layout of individual_metrics.pickle.
+
+        Args:
+            model_names (list, optional): models to read. Defaults to None, every stored model.
+            files (list, optional): test set, see load. Defaults to None, the only test set
+                every model is stored for.
+
+        Returns:
+            [dict]: model name -> {'mses', 'mse_mean', 'mse_std', 'dssims', ..., 'psnr_std'}
+        """
+        df = self.load(model_names, files=files)
+        self._single_test_set(df)
+        individual = dict()
+        for name, model_df in df.groupby('MODEL', sort=False):
+            individual[name] = dict()
+            for m in METRICS:
+                values = model_df[m.upper()].to_numpy()
+                individual[name][m+'s'] = values.tolist()
+                individual[name][m+'_mean'] = np.mean(values)
+                individual[name][m+'_std'] = np.std(values)
+        return individual
@@ -0,0 +1,76 @@
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import glob
+import os
+from collections import OrderedDict
+import numpy as np
+import tensorflow as tf
+
+
+class ModelRegistry():
+    """Cache of the trained models of several result folders.
+
+    Every .h5 is deserialized once and kept in memory. When the weights of the cached
+    models exceed the memory budget, the least recently used models are dropped
+    (and loaded again if they are requested later).
+    """
+
+    def __init__(self, custom_objects=None, memory_budget_mb=2048):
+        """
+        Args:
+            custom_objects (dict, optional): custom losses/metrics for load_model. Defaults to None.
+            memory_budget_mb (int, optional): memory for model weights, in MB. The last model
+                requested is always kept, even if it is larger. Defaults to 2048.
+        """
+        self.custom_objects = custom_objects
+        self.memory_budget = memory_budget_mb * 2**20
+        self._models = OrderedDict() #model path -> (model name, model, weight bytes), LRU first
+        self._paths = dict() #model folder -> model path
+
+    def model_path(self, model_folder):
+        """Path of the .h5 of a result folder, globbed only the first time."""
+        if model_folder not in self._paths:
+            self._paths[model_folder] = glob.glob(os.path.join(model_folder, '*.h5'))[0]
+        return self._paths[model_folder]
+
+    def model_name(self, model_folder):
+        return os.path.basename(self.model_path(model_folder))[:-3]
+
+    @staticmethod
+    def model_nbytes(model):
+        """Memory taken by the weights of a model."""
+        return sum(int(np.prod(w.shape)) * tf.as_dtype(w.dtype).size for w in model.weights)
+
+    def nbytes(self):
+        """Memory taken by the weights of every cached model."""
+        return sum(nbytes for _, _, nbytes in self._models.values())
+
+    def get(self, model_folder):
+        """Model of a result folder, loaded only if it is not cached.
+
+        Args:
+            model_folder (str): result folder with one .h5 model.
+
+        Returns:
+            [tuple]: (model name, tf.keras.Model)
+        """
+        path = self.model_path(model_folder)
+        if path in self._models:
+            self._models.move_to_end(path)
+            name, model, _ = self._models[path]
+            return name, model
+
+        model = tf.keras.models.load_model(path, custom_objects=self.custom_objects)
+        name = self.model_name(model_folder)
+        self._models[path] = (name, model, self.model_nbytes(model))
+        self._evict()
+        return name, model
+
+    def _evict(self):
+        while len(self._models) > 1 and self.nbytes() > self.memory_budget:
+            self._models.popitem(last=False)
+
+    def clear(self):
+        self._models.clear()
@@ -1,11 +1,46 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 import numpy as np
+import pandas as pd
 from tensorflow.keras.utils import Sequence
 
+BUFFER_DTYPES = ['float32', 'float16', 'uint8']
+PREFETCH_MODES = ['thread', 'process']
+
+
 class DataGenerator(Sequence):
     'Generates data for Keras'
     def __init__(self, list_IDs, batch_size=8, dim=(256, 256), n_channels=1, 
-                 shuffle=True, std_normalization=False, augment=False, to_fit=True, f_aug=None):
-        'Initialization'
+                 shuffle=True, std_normalization=False, augment=False, to_fit=True, f_aug=None,
+                 dtype='float32', n_buffers=None, prefetch=0, prefetch_workers=2, prefetch_mode='thread'):
+        """
+        Args:
+            dtype (str, optional): dtype of the batches, see BUFFER_DTYPES. 'uint8' stores every
+                slice min-max scaled to [0, 255] and leaves the division by 255 (self.scale) to the
+                model, e.g. a Rescaling(1/255) first layer. Defaults to 'float32'.
+            n_buffers (int, optional): batches preallocated and reused in a ring: batch index
+                is written into buffer index % n_buffers. It must be larger than the batches alive
+                at once (fit's max_queue_size + workers + 1), otherwise a queued batch is
+                overwritten. Defaults to None, a new array per batch.
+            prefetch (int, optional): batches loaded (and augmented) ahead in a worker pool,
+                following the shuffled order of the epoch. Each __getitem__ keeps at most
+                prefetch batches pending, a batch not prefetched is loaded in the calling thread.
+                With ring buffers, n_buffers must also cover them (at least prefetch + 1). Defaults
+                to 0, no prefetch.
+            prefetch_workers (int, optional): workers of the pool. Defaults to 2.
+            prefetch_mode (str, optional): 'thread' (np.load and most NumPy ops release the GIL)
+                or 'process' (spawned processes, for augmentations holding the GIL; f_aug must be
+                picklable and ring buffers are not used). Defaults to 'thread'.
+
+        Without augmentation the target of a batch is the same array as its input.
+        Call close() when done with a prefetching generator to stop its pool.
+        """
+        assert dtype in BUFFER_DTYPES, 'dtype does not belong to the possible ones'
+        assert prefetch_mode in PREFETCH_MODES, 'prefetch_mode does not belong to the possible ones'
+        assert not (dtype=='uint8' and std_normalization), 'std_normalization needs a float dtype'
+        assert not (n_buffers and prefetch) or n_buffers > prefetch, 'n_buffers must be larger than prefetch'
         self.dim = dim
         self.batch_size = batch_size
         self.list_IDs = list_IDs
@@ -16,6 +51,18 @@ class DataGenerator(Sequence):
         self.to_fit = to_fit
         self.f_aug = f_aug
         self.augment = augment
+        self.dtype = np.dtype(dtype)
+        self.scale = 1/255 if dtype=='uint8' else 1.
+        self.n_buffers = n_buffers
+        self._buffers = None
+        if n_buffers:
+            self._buffers = np.empty((n_buffers, batch_size, *dim, n_channels), dtype=self.dtype)
+        self.prefetch = prefetch
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_mode = prefetch_mode
+        self._executor = None
+        self._pending = dict() #batch index -> future
+        self._lock = threading.Lock()
         self.on_epoch_end()
 
     def __len__(self):
@@ -24,48 +71,112 @@ class DataGenerator(Sequence):
 
     def __getitem__(self, index):
         'Generate one batch of data'
+        if not self.prefetch:
+            return self._load_batch(self._batch_IDs(index), index)
+
+        with self._lock:
+            future = self._pending.pop(index, None)
+            window = range(index+1, min(index+self.prefetch, len(self)-1)+1)
+            # Backpressure: only the next prefetch batches stay pending
+            stale = [self._pending.pop(i) for i in list(self._pending) if i not in window]
+            running = [f for f in stale if not f.cancel()]
+            # A load already running still writes into its ring buffer slot, that the batches
+            # of the new window (or this one) may use: let it finish before reusing the slots
+            if running and self._buffers is not None:
+                wait(running)
+            for i in window:
+                if i not in self._pending:
+                    self._pending[i] = self._submit(i)
+        if future is not None and not future.cancel():
+            return future.result()
+        return self._load_batch(self._batch_IDs(index), index)
+
+    def _batch_IDs(self, index):
+        'IDs of a batch in the order of the current epoch'
         # Generate indexes of the batch
         indexes = self.indexes[index*self.batch_size:(index+1)*self.batch_size]
 
         # Find list of IDs
-        list_IDs_temp = [self.list_IDs[k] for k in indexes]
+        return [self.list_IDs[k] for k in indexes]
 
-        # Generate data
-        batch_x = self.__data_generation(list_IDs_temp)
-        
-        if self.to_fit:
-            batch_x, batch_y = batch_x
-            
-            if self.augment:
-                return np.stack([
-                    self._augment(image=x) for x in batch_x
-                ], axis=0), np.array(batch_y)
+    def _submit(self, index):
+        'Load a batch in the prefetch pool'
+        if self._executor is None:
+            if self.prefetch_mode == 'process':
+                self._executor = ProcessPoolExecutor(self.prefetch_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=_init_prefetch_worker, initargs=(self,))
             else:
-                 return batch_x, batch_y
-        else:
-            if self.augment:
-                return np.stack([
-                    self._augment(image=x) for x in batch_x
-                ], axis=0)
-            else:
-                return batch_x
+                self._executor = ThreadPoolExecutor(self.prefetch_workers)
+        if self.prefetch_mode == 'process':
+            return self._executor.submit(_prefetch_worker_batch, self._batch_IDs(index), index)
+        return self._executor.submit(self._load_batch, self._batch_IDs(index), index)
+
+    def _cancel_prefetch(self):
+        'Drop the pending batches, waiting for the ones already running'
+        with self._lock:
+            pending = list(self._pending.values())
+            self._pending.clear()
+        for future in pending:
+            future.cancel()
+        wait(pending)
 
+    def close(self):
+        'Stop the prefetch pool'
+        self._cancel_prefetch()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def __getstate__(self):
+        'Copy for the process pool workers: no pool, no prefetch and no ring buffers'
+        state = self.__dict__.copy()
+        state.update(_executor=None, _pending=dict(), _lock=None, _buffers=None, prefetch=0)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def _load_batch(self, list_IDs_temp, index):
+        'Load, preprocess and augment a batch'
+        # Generate data
+        X = self._data_generation(list_IDs_temp, self._batch_buffer(index))
+
+        if self.augment:
+            #the augmented input is a new array, the clean buffer is kept as target
+            batch_x = np.stack([self._augment(image=x) for x in X], axis=0).astype(self.dtype, copy=False)
+            return (batch_x, X) if self.to_fit else batch_x
+        #autoencoder target identical to the input: both share one array
+        return (X, X) if self.to_fit else X
+
+    def _batch_buffer(self, index):
+        'Array to write the batch into: a ring buffer slot or a new array'
+        if self._buffers is not None:
+            return self._buffers[index % self.n_buffers]
+        return np.empty((self.batch_size, *self.dim, self.n_channels), dtype=self.dtype)
+
+    def _to_buffer_dtype(self, img):
+        'Scale a float32 image for the buffer dtype (uint8: min-max to [0, 255])'
+        if self.dtype == np.uint8:
+            low, high = img.min(), img.max()
+            return np.rint((img-low)*(255/(high-low) if high > low else 0))
+        return img
 
     def on_epoch_end(self):
         'Updates indexes after each epoch'
+        # Batches prefetched in the previous order are no longer valid
+        self._cancel_prefetch()
         self.indexes = np.arange(len(self.list_IDs))
         if self.shuffle == True:
             np.random.shuffle(self.indexes)
 
-    def __data_generation(self, list_IDs_temp):
-        'Generates data containing batch_size samples' # X : (n_samples, *dim, n_channels)
-        # Initialization
-        X = np.empty((self.batch_size, *self.dim, self.n_channels))
-        
+    def _data_generation(self, list_IDs_temp, X):
+        'Generates data containing batch_size samples into X' # X : (n_samples, *dim, n_channels)
          # Generate data
         for i, ID in enumerate(list_IDs_temp):
             #Load
-            img = np.load(ID)
+            img = np.load(ID).astype(np.float32)
             img = np.expand_dims(img, axis=2)
             #Preprocess Sample
             if self.std_normalization:
@@ -73,12 +184,8 @@ class DataGenerator(Sequence):
             
             # Store sample 
             assert img.shape==(256,256,1),"BAD INPUT IMAGE:"+str(img.shape)
-            X[i,] = img
-            
-        if self.to_fit:
-            return X, X.copy()
-        else:
-            return X    
+            X[i,] = self._to_buffer_dtype(img)
+        return X
         
     
     def _augment(self, image):
@@ -87,4 +194,83 @@ class DataGenerator(Sequence):
         if self.f_aug:
             image = self.f_aug(image)
         assert image.shape==(256,256,1),"BAD INPUT IMAGE:"+str(image.shape)
-        return image
\ No newline at end of file
+        return image
+
+
+_prefetch_generator = None
+
+
+def _init_prefetch_worker(generator):
+    'Keep the generator copy of a process pool worker, with its own augmentation seed'
+    global _prefetch_generator
+    _prefetch_generator = generator
+    np.random.seed((os.getpid()*7919) % 2**32)
+
+
+def _prefetch_worker_batch(list_IDs_temp, index):
+    return _prefetch_generator._load_batch(list_IDs_temp, index)
+
+
+def load_slice_store(store_path):
+    """Open a slice store written by DeepBrainSliceExtractor with out_format='memmap'.
+
+    Args:
+        store_path (str): path of the N x 256 x 256 .npy array of a partition.
+
+    Returns:
+        [tuple]: (read-only np.memmap, DataFrame index with SLICE_ID, IXI_ID and BRAIN_QUANTITY per row)
+    """
+    store = np.load(store_path, mmap_mode='r')
+    index = pd.read_csv(store_path[:-4]+'_index.csv')
+    assert len(index)==len(store),"Slice store and its index do not match"
+    return store, index
+
+
+class MemmapDataGenerator(DataGenerator):
+    'Generates data for Keras from a memory-mapped slice store'
+    def __init__(self, store_path, rows=None, batch_size=8, dim=(256, 256), n_channels=1, 
+                 shuffle=True, std_normalization=False, augment=False, to_fit=True, f_aug=None,
+                 dtype='float32', n_buffers=None, prefetch=0, prefetch_workers=2, prefetch_mode='thread'):
+        """Batches are served by fancy-indexing one memory-mapped array, with no per-sample file opens.
+
+        Args:
+            store_path (str): path of the .npy slice store of a partition.
+            rows ([iterable:int], optional): rows of the store to use (e.g. train or validation
+                subset). Defaults to None, every row.
+        """
+        self.store_path = store_path
+        self.store, self.store_index = load_slice_store(store_path)
+        rows = np.arange(len(self.store)) if rows is None else np.asarray(rows)
+        super().__init__(rows, batch_size=batch_size, dim=dim, n_channels=n_channels,
+                         shuffle=shuffle, std_normalization=std_normalization,
+                         augment=augment, to_fit=to_fit, f_aug=f_aug,
+                         dtype=dtype, n_buffers=n_buffers, prefetch=prefetch,
+                         prefetch_workers=prefetch_workers, prefetch_mode=prefetch_mode)
+
+    def __getstate__(self):
+        'The process pool workers map the store again instead of receiving a copy'
+        state = super().__getstate__()
+        state.update(store=None, store_index=None)
+        return state
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        self.store, self.store_index = load_slice_store(self.store_path)
+
+    def _data_generation(self, list_IDs_temp, X):
+        'Generates data containing batch_size samples into X' # X : (n_samples, *dim, n_channels)
+        # Sorted rows turn the batch into mostly sequential reads of the store
+        slices = self.store[np.sort(list_IDs_temp)]
+        assert slices.shape[1:]==self.dim and X.shape[-1]==self.n_channels,"BAD INPUT IMAGE:"+str(slices.shape)
+
+        if self.std_normalization:
+            slices = slices.astype(np.float32)
+            slices = (slices-slices.mean(axis=(1,2), keepdims=True))/slices.std(axis=(1,2), keepdims=True)
+        elif self.dtype == np.uint8:
+            slices = slices.astype(np.float32)
+            low = slices.min(axis=(1,2), keepdims=True)
+            value_range = slices.max(axis=(1,2), keepdims=True)-low
+            slices = np.rint((slices-low)*(255/np.where(value_range > 0, value_range, np.inf)))
+
+        np.copyto(X[..., 0], slices, casting='unsafe')
+        return X
@@ -1,17 +1,174 @@
 import tensorflow as tf
 import tensorflow_addons as tfa
+import os
+import glob
+import json
+import shutil
+import hashlib
+import random
+from tfrecord_shards import shard_files, decode_image
+from nifti_slices import NiftiSliceSource, SLICE_SHAPE, CACHE_VOLUMES, BRAIN_QUANTITY_PATH
+
+#Bump when parse_image changes, so every persistent snapshot is rebuilt
+SNAPSHOT_VERSION = 2
+SNAPSHOT_SHARDS = 64
+NORMALIZATION = 'min_max'
+SOURCES = ['files', 'tfrecord', 'nifti']
+TFRECORD_READERS = 8 #shards read at once by the interleave
+NIFTI_READERS = 4 #volumes decoded at once and mixed by the interleave
+CALLBACK_PROGRESS = ['best', 'wait', 'cooldown_counter'] #attributes of the callbacks saved by PipelineCheckpoint
 
 
 class tf_data_png_loader():
-    def __init__(self, files_path, batch_size=8, cache=False, shuffle_buffer_size=1000, resize=(128,128), train=True, augment=False):
+    def __init__(self, files_path, batch_size=8, cache=False, shuffle_buffer_size=1000, resize=(128,128), train=True, augment=False,
+                 snapshot_dir=None, snapshot_name='ds', seed=None, initial_step=0, num_shards=1, shard_index=0,
+                 source='files', volume_cache=CACHE_VOLUMES, brain_quantity_path=BRAIN_QUANTITY_PATH):
+        """
+        Args:
+            files_path (list|str): image files, the shard folder written by tfrecord_shards.py
+                with source='tfrecord', or .nii.gz volumes with source='nifti'.
+            snapshot_dir (str, optional): folder for a persistent snapshot of the decoded, resized and
+                normalized images. The first run writes it and later runs (e.g. every experiment after
+                the first) read it instead of decoding PNGs. Defaults to None, no snapshot.
+            snapshot_name (str, optional): name of the snapshot. Loaders sharing snapshot_dir need
+                different names: a snapshot with the same name and other key is deleted as stale.
+            seed (int, optional): makes the pipeline deterministic: seeded shuffles and stateless
+                augmentation keyed by (seed, batch number), so two runs yield the same batches.
+                Defaults to None, unseeded.
+            initial_step (int, optional): batches to skip, to resume a seeded training pipeline
+                where a PipelineCheckpoint left it. Defaults to 0.
+            num_shards (int, optional): workers reading disjoint parts of files_path (multi-worker
+                training). Files are sharded before decoding (and before the snapshot, that is
+                named per shard) and tf.distribute auto-sharding is turned off. batch_size must
+                still be the global batch: tf.distribute splits the batch of every worker over all
+                the replicas. Defaults to 1.
+            shard_index (int, optional): shard of this worker, in [0, num_shards). Defaults to 0.
+                With source='tfrecord' the workers split the TFRecord shards.
+            source (str, optional): 'files' (one image file per slice), 'tfrecord' (compressed
+                shards read with a parallel interleave, in random order when training) or 'nifti'
+                (relevant slices of the volumes, see nifti_slices.py, several volumes interleaved;
+                a snapshot_dir stores a decoded copy of every slice, that source is meant to avoid).
+                Defaults to 'files'.
+            volume_cache (int, optional): decoded volumes kept in memory with source='nifti'.
+                Defaults to CACHE_VOLUMES.
+            brain_quantity_path (str, optional): table selecting the slices with source='nifti'.
+                Defaults to BRAIN_QUANTITY_PATH.
+        """
+        assert 0 <= shard_index < num_shards, 'shard_index must be in [0, num_shards)'
+        assert source in SOURCES, 'source does not belong to the possible ones'
+        self.source = source
+        self.tfrecord_meta = None
+        if source == 'tfrecord':
+            files_path, self.tfrecord_meta = shard_files(files_path)
+            assert len(files_path) >= num_shards, 'Fewer TFRecord shards than workers'
+        if num_shards > 1:
+            #every worker must shard the same order, whatever order it got the files in
+            files_path = sorted(files_path) if train else list(files_path)
+            files_path = files_path[shard_index::num_shards]
+            snapshot_name = snapshot_name+'_shard'+str(shard_index)+'of'+str(num_shards)
+        self.num_shards = num_shards
+        self.shard_index = shard_index
         self.files_path = files_path
         self.samples = len(self.files_path)
+        if source == 'tfrecord':
+            self.samples = sum(self.tfrecord_meta['shards'][os.path.basename(f)] for f in files_path)
+        self.brain_quantity_path = brain_quantity_path
+        self.nifti = None
+        if source == 'nifti':
+            self.nifti = NiftiSliceSource(files_path, brain_quantity_path, cache_volumes=volume_cache)
+            self.samples = self.nifti.samples
         self.batch_size = batch_size
         self.cache = cache
         self.shuffle_buffer_size = shuffle_buffer_size
         self.resize = resize
         self.train = train
         self.augment = augment
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_name = snapshot_name
+        self.seed = seed
+        self.initial_step = initial_step
+
+    def snapshot_path(self):
+        """Path of the snapshot for the current settings and the files it is built from.
+
+        The key hashes the snapshot version, the files (with their modification time), the resize
+        and the normalization, so any change invalidates the snapshot. Training loaders shuffle
+        anyway, so their key uses the sorted files and does not depend on the order they are given.
+
+        Returns:
+            [tuple]: (snapshot path, list of files in snapshot order)
+        """
+        files = sorted(self.files_path) if self.train else list(self.files_path)
+        key = {'version': SNAPSHOT_VERSION,
+               'files': files,
+               'mtimes': [os.path.getmtime(f) for f in files],
+               'resize': self.resize,
+               'normalization': NORMALIZATION,
+               'train': self.train}
+        if self.source == 'nifti':
+            key['brain_quantity'] = [self.brain_quantity_path, os.path.getmtime(self.brain_quantity_path)]
+        digest = hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, self.snapshot_name+'_'+digest), files
+
+    def read_source(self, parse, files, shuffle_files=False):
+        """Dataset of parsed (image, image) from image files, TFRecord shards or volumes.
+
+        Args:
+            parse (function): parse_image of a file path, a serialized example or a slice.
+            files (list): image files, shards or volumes.
+            shuffle_files (bool, optional): read the files, shards or volumes in a new random order
+                every epoch, so the shuffle buffer is not fed slices grouped by volume. Defaults to False.
+        """
+        AUTOTUNE = tf.data.experimental.AUTOTUNE
+        ds = tf.data.Dataset.from_tensor_slices(files)
+        if shuffle_files:
+            ds = ds.shuffle(len(files), seed=self.seed)
+        if self.source == 'tfrecord':
+            #few large sequential reads, several shards at once
+            ds = ds.interleave(lambda shard: tf.data.TFRecordDataset(shard, compression_type=self.tfrecord_meta['compression']),
+                               cycle_length=min(len(files), TFRECORD_READERS),
+                               num_parallel_calls=AUTOTUNE)
+        elif self.source == 'nifti':
+            #slices of NIFTI_READERS volumes alternate, so the shuffle buffer mixes volumes
+            ds = ds.interleave(lambda volume: tf.data.Dataset.from_generator(self.nifti.volume_slices,
+                                                                             output_types=tf.float32,
+                                                                             output_shapes=SLICE_SHAPE+(1,),
+                                                                             args=(volume,)),
+                               cycle_length=min(len(files), NIFTI_READERS),
+                               num_parallel_calls=AUTOTUNE)
+        return ds.map(parse, num_parallel_calls=AUTOTUNE)
+
+    def load_snapshot(self, parse_image):
+        """Dataset of (image, image) read from the persistent snapshot, written first if missing."""
+        AUTOTUNE = tf.data.experimental.AUTOTUNE
+        path, files = self.snapshot_path()
+        n_shards = SNAPSHOT_SHARDS if self.train else 1
+        shape = tuple(self.resize if self.resize else (256,256)) + (1,)
+        element_spec = (tf.TensorSpec((), tf.int64), tf.TensorSpec(shape, tf.float32))
+
+        if not os.path.isdir(path):
+            #Stale snapshots (other key) and unfinished ones of this name
+            for stale in glob.glob(os.path.join(self.snapshot_dir, self.snapshot_name+'_'+'?'*16+'*')):
+                shutil.rmtree(stale, ignore_errors=True)
+            if self.train:
+                #Written in a seeded random order: it is read back almost in the written order
+                #(round robin over the shards), and a sorted order groups the slices by volume
+                files = list(files)
+                random.Random(self.seed).shuffle(files)
+            ds = self.read_source(parse_image, files)
+            ds = ds.map(lambda x, y: x).enumerate()
+            tf.data.experimental.save(ds, path+'.tmp', shard_func=lambda i, x: i % n_shards)
+            os.rename(path+'.tmp', path)
+
+        if self.train:
+            #Read the shards in a new random order every epoch, before the shuffle buffer
+            reader_func = lambda datasets: datasets.shuffle(n_shards, seed=self.seed).interleave(lambda x: x,
+                                                                                 cycle_length=n_shards,
+                                                                                 num_parallel_calls=AUTOTUNE)
+        else:
+            reader_func = None
+        ds = tf.data.experimental.load(path, element_spec, reader_func=reader_func)
+        return ds.map(lambda i, x: (x, tf.identity(x)), num_parallel_calls=AUTOTUNE)
         
     def get_tf_ds_generator(self):
         """
@@ -26,7 +183,15 @@ class tf_data_png_loader():
             # load the raw data from the file as a string
             img = tf.io.read_file(file_path)
             # convert the compressed string to a 3D float tensor
-            img = tf.io.decode_png(img, channels=1)
+            # (16-bit grayscale PNGs, 8-bit ones are scaled to 16 bits)
+            img = tf.io.decode_png(img, channels=1, dtype=tf.uint16)
+            return preprocess(img)
+
+        def parse_record(serialized):
+            # slice of a TFRecord shard, in the dtype it was written in
+            return preprocess(decode_image(serialized, self.tfrecord_meta['image']))
+
+        def preprocess(img):
             img = tf.image.convert_image_dtype(img, tf.float32)
             
             if self.resize and self.resize !=(256,256):
@@ -51,32 +216,55 @@ class tf_data_png_loader():
 
             if self.train:
                 #https://stackoverflow.com/questions/46444018/meaning-of-buffer-size-in-dataset-map-dataset-prefetch-and-dataset-shuffle
-                ds = ds.shuffle(buffer_size=shuffle_buffer_size)
+                ds = ds.shuffle(buffer_size=shuffle_buffer_size, seed=self.seed)
 
             # representing the number of times the dataset should be repeated. 
             # The default behavior (if count is None or -1) is for the dataset be repeated indefinitely.
             if self.train:
                 ds = ds.repeat()
             
-            if self.augment:
-                ds = ds.map(self.img_augment, num_parallel_calls=AUTOTUNE)
-            
             ds = ds.batch(self.batch_size)
+
+            # Batch number, seeds the augmentation of each batch and lets a resumed run skip
+            # the batches already seen without augmenting them
+            ds = ds.enumerate()
+            if self.initial_step:
+                ds = ds.skip(self.initial_step)
             
-            #HERE AUGMENTATION works on batches
-            #aug_ds = train_ds.map(lambda x, y: (resize_and_rescale(x, training=True), y))
+            #Augmentation works on whole batches, with per-sample random parameters
+            if self.augment:
+                if self.seed is None:
+                    ds = ds.map(lambda i, batch: self.batch_augment(*batch), num_parallel_calls=AUTOTUNE)
+                else:
+                    ds = ds.map(lambda i, batch: self.batch_augment(*batch, seed=tf.stack([tf.constant(self.seed, tf.int64), i])),
+                                num_parallel_calls=AUTOTUNE)
+            else:
+                ds = ds.map(lambda i, batch: batch)
 
             if self.train:
                 # `prefetch` lets the dataset fetch batches in the background while the model is training.
                 ds = ds.prefetch(buffer_size=AUTOTUNE)
             return ds
 
-        #Get all path files
-        ds = tf.data.Dataset.from_tensor_slices(self.files_path)
-
         # Set `num_parallel_calls` so that multiple images are processed in parallel
         AUTOTUNE = tf.data.experimental.AUTOTUNE
-        ds = ds.map(parse_image, num_parallel_calls=AUTOTUNE)
+
+        parse = {'files': parse_image, 'tfrecord': parse_record, 'nifti': preprocess}[self.source]
+        if self.snapshot_dir:
+            # Decoded images from a previous run, augmentation is still applied after it
+            ds = self.load_snapshot(parse)
+        else:
+            #Get all path files
+            ds = self.read_source(parse, self.files_path, shuffle_files=self.train)
+
+        if self.seed is not None or self.num_shards > 1:
+            options = tf.data.Options()
+            if self.seed is not None:
+                options.experimental_deterministic = True
+            if self.num_shards > 1:
+                #already sharded by file, tf.distribute must not shard it again
+                options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+            ds = ds.with_options(options)
 
         # cache = True, False, './file_name'
         # If the dataset doesn't fit in memory use a cache file,eg. cache='./data.tfcache'
@@ -88,7 +276,7 @@ class tf_data_png_loader():
         #Noise and Dropout
         rnds_noise = tf.random.uniform((1,2),minval=0, maxval=0.04)
         image = tf.nn.dropout(image,rnds_noise[0][0])
-        image = tf.keras.layers.GaussianNoise(rnds_noise[0][1])(image, training=True)
+        image = image + tf.random.normal(tf.shape(image), stddev=rnds_noise[0][1])
         
         #Blankout and blur
         rnds_absolutes = tf.random.uniform((1,2),minval=0, maxval=1)
@@ -110,4 +298,147 @@ class tf_data_png_loader():
         image = tf.math.divide(tf.math.subtract(image, tf.math.reduce_min(image)),
                                     tf.math.subtract(tf.math.reduce_max(image), tf.math.reduce_min(image)))
         return image, label
-    
+
+    def batch_augment(self, images, labels, seed=None):
+        """Vectorized version of img_augment over a batch (b, h, w, 1).
+
+        Every sample draws its own dropout rate, noise level, cutout and blur as in
+        img_augment, but the corruptions are applied to the whole batch at once with masks
+        instead of one small graph per image.
+
+        Args:
+            seed (Tensor, optional): int64 [2] seed. When given, stateless random ops are used
+                and the augmentation only depends on the seed. Defaults to None.
+        """
+        shape = tf.shape(images)
+        b, h, w = shape[0], shape[1], shape[2]
+
+        def uniform(shape, k, minval=0, maxval=None, dtype=tf.float32):
+            if seed is None:
+                return tf.random.uniform(shape, minval=minval, maxval=maxval, dtype=dtype)
+            return tf.random.stateless_uniform(shape, seed=seed + [k, 0], minval=minval, maxval=maxval, dtype=dtype)
+
+        def normal(shape, k):
+            if seed is None:
+                return tf.random.normal(shape)
+            return tf.random.stateless_normal(shape, seed=seed + [k, 0])
+
+        #Noise and Dropout
+        rnds_noise = uniform((b,2,1,1,1), 0, minval=0, maxval=0.04)
+        drop_rate, noise_std = rnds_noise[:,0], rnds_noise[:,1]
+        keep = tf.cast(uniform(shape, 1) >= drop_rate, images.dtype)
+        images = images * keep / (1. - drop_rate)
+        images = images + normal(shape, 2) * noise_std
+
+        #Blankout: square of side size centered at (offset, offset), like tfa.image.cutout
+        rnds_absolutes = uniform((b,2), 3, minval=0, maxval=1)
+        size = uniform((b,1,1,1), 4, minval=10, maxval=40, dtype=tf.dtypes.int32)
+        offset = uniform((b,1,1,1), 5, minval=10, maxval=100, dtype=tf.dtypes.int32)
+        rows = tf.reshape(tf.range(h), (1,-1,1,1))
+        cols = tf.reshape(tf.range(w), (1,1,-1,1))
+        lower, upper = offset - size//2, offset - size//2 + size
+        in_square = (rows >= lower) & (rows < upper) & (cols >= lower) & (cols < upper)
+        cutout = tf.reshape(rnds_absolutes[:,0] < 0.2, (-1,1,1,1))
+        images = tf.where(in_square & cutout, tf.zeros_like(images), images)
+
+        #Blur
+        blurred = tfa.image.gaussian_filter2d(images,
+                                              filter_shape = [3, 3],
+                                              sigma = 0.6,
+                                              constant_values = 0,
+                                              )
+        blur = tf.reshape(rnds_absolutes[:,1] < 0.1, (-1,1,1,1))
+        images = tf.where(blur, blurred, images)
+
+        # Normalization per sample
+        img_min = tf.math.reduce_min(images, axis=[1,2,3], keepdims=True)
+        img_max = tf.math.reduce_max(images, axis=[1,2,3], keepdims=True)
+        images = tf.math.divide(tf.math.subtract(images, img_min), tf.math.subtract(img_max, img_min))
+        return images, labels
+
+
+class PipelineCheckpoint(tf.keras.callbacks.Callback):
+    """Saves the model together with the position of a seeded training pipeline.
+
+    The model (weights and optimizer) and a json state with the seed, the number of loader
+    batches consumed and the epoch are written at the same time, so a preempted run can be resumed
+    with tf_data_png_loader(seed=state['seed'], initial_step=state['step']) and
+    fit(initial_epoch=state['epoch']) without repeating or skipping batches.
+    state['step'] counts batches of the loader, not training steps: in multi-worker training every
+    step takes 1/num_workers of the batch of each worker, so a loader batch is steps_per_batch
+    (num_workers) steps, and the model is only saved after whole loader batches. The progress of the
+    given callbacks (best monitored value, epochs waited) is saved too, so a resumed
+    ModelCheckpoint(save_best_only=True) or EarlyStopping goes on as in an uninterrupted run.
+    """
+    def __init__(self, model_path, state_path, seed, initial_step=0, save_freq='epoch',
+                 callbacks=None, callback_state=None, steps_per_batch=1):
+        """
+        Args:
+            model_path (str): .h5 path of the last model, overwritten on every save.
+            state_path (str): .json path of the pipeline state.
+            seed (int): seed of the training loader.
+            initial_step (int, optional): loader batches already consumed when fit starts, the
+                initial_step of the loader. Defaults to 0.
+            save_freq (str|int, optional): 'epoch' or a number of training steps, multiple of
+                steps_per_batch. Mid-epoch saves resume at the same batch, but the epoch counted
+                by Keras restarts. Defaults to 'epoch'.
+            callbacks (list, optional): callbacks whose progress is saved, e.g. ModelCheckpoint,
+                EarlyStopping, ReduceLROnPlateau. Defaults to None.
+            callback_state (dict, optional): state['callbacks'] of the run being resumed, restored
+                into callbacks when the first epoch begins. Defaults to None.
+            steps_per_batch (int, optional): training steps that consume one loader batch, the
+                number of workers in multi-worker training. Defaults to 1.
+        """
+        assert save_freq == 'epoch' or save_freq % steps_per_batch == 0, 'save_freq must be a multiple of steps_per_batch'
+        super().__init__()
+        self.model_path = model_path
+        self.state_path = state_path
+        self.seed = seed
+        self.steps_per_batch = steps_per_batch
+        self.step = initial_step * steps_per_batch #training steps
+        self.save_freq = save_freq
+        self.epoch = 0
+        self.callbacks = {type(callback).__name__: callback for callback in callbacks or []}
+        self.callback_state = callback_state
+
+    def on_train_begin(self, logs=None):
+        steps = self.params.get('steps')
+        if self.save_freq == 'epoch' and steps and steps % self.steps_per_batch:
+            raise Exception('Epochs of '+str(steps)+' steps end in the middle of a loader batch, '
+                            'steps_per_epoch must be a multiple of '+str(self.steps_per_batch))
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch = epoch
+        #after on_train_begin, where EarlyStopping and ReduceLROnPlateau reset their progress
+        if self.callback_state:
+            for name, attrs in self.callback_state.items():
+                for attr, value in attrs.items():
+                    setattr(self.callbacks[name], attr, value)
+            self.callback_state = None
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.step += 1
+        if self.save_freq != 'epoch' and self.step % self.save_freq == 0:
+            self._save(self.epoch)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.save_freq == 'epoch':
+            self._save(epoch+1)
+
+    def _save(self, epoch):
+        self.model.save(self.model_path)
+        with open(self.state_path+'.tmp', 'w') as handle:
+            json.dump({'seed': self.seed, 'step': self.step // self.steps_per_batch, 'epoch': epoch,
+                       'steps_per_batch': self.steps_per_batch,
+                       'callbacks': self.get_callback_state()}, handle)
+        os.replace(self.state_path+'.tmp', self.state_path)
+
+    def get_callback_state(self):
+        return {name: {attr: float(getattr(callback, attr)) if attr == 'best' else int(getattr(callback, attr))
+                       for attr in CALLBACK_PROGRESS if hasattr(callback, attr)}
+                for name, callback in self.callbacks.items()}
+
+    @staticmethod
+    def load_state(state_path):
+        with open(state_path) as handle:
+            return json.load(handle)
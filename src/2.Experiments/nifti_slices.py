@@ -0,0 +1,119 @@
+""" Relevant sagittal slices read straight from the .nii.gz volumes, for
+tf_data_png_loader(source='nifti'): training on a cohort without extracting its slices first.
+
+The slices of a volume are the ones DeepBrainSliceExtractor would extract: those whose brain
+quantity in slice_brain_quantity.csv exceeds the threshold, rotated like the extracted images.
+A bounded LRU cache keeps the relevant slices of the last decoded volumes (in their on-disk
+dtype), so the following epochs do not decompress them again while the cache holds the cohort.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+BRAIN_QUANTITY_PATH = '..'+os.path.sep+'IXI-T1'+os.path.sep+'slice_brain_quantity.csv'
+BRAIN_QUANTITY_THRESHOLD = 3000 #as DeepBrainSliceExtractor
+SLICE_SHAPE = (256, 256)
+CACHE_VOLUMES = 32 #a volume is ~150 relevant slices, ~20 MB in int16
+
+
+def volume_name(volume_path):
+    """'.../IXI002-Guys-0828-T1.nii.gz' -> 'IXI002-Guys-0828-T1'"""
+    return os.path.basename(volume_path)[:-7]
+
+
+def relevant_slices_table(csv_path=BRAIN_QUANTITY_PATH, min_brain_quantity=BRAIN_QUANTITY_THRESHOLD):
+    """Sorted indices of the relevant slices of every volume in the brain quantity table.
+
+    Args:
+        csv_path (str, optional): table with 'ID' ('<volume>_<slice>') and 'BRAIN_QUANTITY'.
+            Defaults to BRAIN_QUANTITY_PATH.
+        min_brain_quantity (int, optional): slices with more brain voxels are relevant.
+            Defaults to BRAIN_QUANTITY_THRESHOLD.
+
+    Returns:
+        [dict]: volume name -> np.ndarray of slice indices
+    """
+    table = pd.read_csv(csv_path)
+    ids = table['ID'].str.rsplit('_', n=1, expand=True)
+    slices = pd.DataFrame({'VOL': ids[0].values, 'SLICE': ids[1].astype(int).values})
+    slices = slices[table['BRAIN_QUANTITY'].values > min_brain_quantity]
+    return {name_vol: np.sort(vol_slices['SLICE'].values) for name_vol, vol_slices in slices.groupby('VOL', sort=False)}
+
+
+class NiftiSliceSource():
+    """Relevant slices of a list of volumes, with an LRU cache of decoded volumes."""
+
+    def __init__(self, volume_files, csv_path=BRAIN_QUANTITY_PATH, min_brain_quantity=BRAIN_QUANTITY_THRESHOLD,
+                 cache_volumes=CACHE_VOLUMES):
+        """
+        Args:
+            volume_files (list): .nii.gz volumes, all of them in the brain quantity table.
+            csv_path (str, optional): brain quantity table. Defaults to BRAIN_QUANTITY_PATH.
+            min_brain_quantity (int, optional): relevance threshold. Defaults to BRAIN_QUANTITY_THRESHOLD.
+            cache_volumes (int, optional): decoded volumes kept in memory. Defaults to CACHE_VOLUMES.
+        """
+        table = relevant_slices_table(csv_path, min_brain_quantity)
+        missing = [f for f in volume_files if volume_name(f) not in table]
+        if missing:
+            raise Exception(str(len(missing))+' volumes are not in '+csv_path+', e.g. '+missing[0])
+        self.slice_ids = {f: table[volume_name(f)] for f in volume_files}
+        self.samples = sum(len(ids) for ids in self.slice_ids.values())
+        self.cache_volumes = cache_volumes
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load_volume(self, volume_path):
+        """Relevant slices of a volume, k x 256 x 256 in the on-disk dtype.
+
+        Only the slab spanning the relevant slices is read through the array proxy, and every
+        slice is rotated 90 degrees like the extracted images.
+        """
+        slice_ids = self.slice_ids[volume_path]
+        if len(slice_ids) == 0:
+            return np.empty((0,)+SLICE_SHAPE)
+        proxy = nib.load(volume_path).dataobj
+        slab = np.asanyarray(proxy[:, :, slice_ids[0]:slice_ids[-1]+1])
+        slab = slab[:, :, slice_ids-slice_ids[0]]
+        slices = np.ascontiguousarray(np.moveaxis(np.rot90(slab, axes=(0,1)), 2, 0))
+        assert slices.shape[1:]==SLICE_SHAPE,"BAD INPUT VOLUME:"+str(slices.shape)
+        return slices
+
+    def volume(self, volume_path):
+        """Relevant slices of a volume, from the cache or decoded (and cached)."""
+        with self._lock:
+            if volume_path in self._cache:
+                self._cache.move_to_end(volume_path)
+                return self._cache[volume_path]
+        #decoded outside the lock, so the parallel readers do not wait for each other
+        slices = self.load_volume(volume_path)
+        with self._lock:
+            self._cache[volume_path] = slices
+            self._cache.move_to_end(volume_path)
+            while len(self._cache) > self.cache_volumes:
+                self._cache.popitem(last=False)
+        return slices
+
+    def volume_slices(self, volume_path):
+        """Generator of the relevant slices of a volume, 256 x 256 x 1 float32.
+
+        Args:
+            volume_path (bytes|str): path of the volume (bytes when called by tf.data).
+        """
+        if isinstance(volume_path, bytes):
+            volume_path = volume_path.decode()
+        for img_slice in self.volume(volume_path):
+            yield img_slice[..., np.newaxis].astype(np.float32)
+
+
+def count_slices(volume_files, csv_path=BRAIN_QUANTITY_PATH, min_brain_quantity=BRAIN_QUANTITY_THRESHOLD):
+    """Number of relevant slices of a list of volumes."""
+    table = relevant_slices_table(csv_path, min_brain_quantity)
+    return sum(len(table.get(volume_name(f), [])) for f in volume_files)
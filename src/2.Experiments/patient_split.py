@@ -0,0 +1,106 @@
+""" Patient-level train/validation split of the extracted slices.
+Every IXI subject (volume) goes entirely to train or to validation, so validation
+slices never come from a brain seen in training.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import glob
+import json
+import os
+import pickle as pkl
+from stratifier_complex import stratified_sample
+
+STRATA = ['ETHNIC_ID','AGE_GROUP','SEX']
+
+
+def ixi_id(file_path):
+    """IXI ID of a slice file, e.g. '.../IXI002-Guys-0828-T1_45.png' -> 2"""
+    return int(os.path.basename(file_path)[3:6])
+
+
+def check_no_leakage(train_files, validation_files):
+    """Raise if any IXI subject has slices in both partitions."""
+    shared = set(map(ixi_id, train_files)) & set(map(ixi_id, validation_files))
+    if shared:
+        raise Exception('Slices of the same volume in train and validation: IXI IDs '+str(sorted(shared)))
+
+
+def patient_level_split(img_files, volumes_df, validation_size, strata=STRATA, seed=None):
+    """Split slice files by volume, sampling the validation volumes stratified by strata.
+
+    Volumes without strata data (NaN) are never sampled, so their slices stay in train,
+    as well as slices of volumes not in volumes_df.
+
+    Args:
+        img_files (list): slice files of train and validation.
+        volumes_df (DataFrame): one row per volume with 'IXI_ID' and the strata columns
+            (data_train_val_volumes_df.pkl).
+        validation_size (float|int): proportion or number of validation volumes.
+        strata (list, optional): columns for stratified_sample. Defaults to STRATA.
+        seed (int, optional): sampling seed. Defaults to None.
+
+    Returns:
+        [tuple]: (train_files, validation_files)
+    """
+    validation_vols = stratified_sample(volumes_df, strata, size=validation_size, seed=seed, keep_index=False)
+    validation_ids = set(validation_vols['IXI_ID'].astype(int))
+
+    train_files, validation_files = [], []
+    for f in img_files:
+        if ixi_id(f) in validation_ids:
+            validation_files.append(f)
+        else:
+            train_files.append(f)
+
+    check_no_leakage(train_files, validation_files)
+    return train_files, validation_files
+
+
+def load_or_create_split(manifest_path, img_folder, volumes_df_path, validation_size, strata=STRATA, seed=None):
+    """Patient-level split cached in a json manifest.
+
+    The manifest is reused while its settings match, so later runs neither rescan
+    img_folder nor sample again. It is recreated if any setting changes.
+
+    Args:
+        manifest_path (str): json file of the split.
+        img_folder (str): folder with the train and validation .png slices.
+        volumes_df_path (str): pickle of the train and validation volumes dataframe.
+        validation_size (float|int): proportion or number of validation volumes.
+        strata (list, optional): columns for stratified_sample. Defaults to STRATA.
+        seed (int, optional): sampling seed. Defaults to None.
+
+    Returns:
+        [tuple]: (train_files, validation_files)
+    """
+    settings = {'img_folder': img_folder,
+                'volumes': volumes_df_path,
+                'validation_size': validation_size,
+                'strata': list(strata),
+                'seed': seed}
+
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as handle:
+            manifest = json.load(handle)
+        if manifest['settings'] == settings:
+            check_no_leakage(manifest['train'], manifest['validation'])
+            return manifest['train'], manifest['validation']
+
+    with open(volumes_df_path, 'rb') as handle:
+        volumes_df = pkl.load(handle)
+    img_files = sorted(glob.glob(img_folder+os.path.sep+'*.png'))
+    train_files, validation_files = patient_level_split(img_files, volumes_df, validation_size,
+                                                        strata=strata, seed=seed)
+
+    manifest_folder = os.path.dirname(manifest_path)
+    if manifest_folder:
+        os.makedirs(manifest_folder, exist_ok=True)
+    #written aside and renamed: workers of a distributed run may create the same manifest at once
+    tmp_path = manifest_path+'.'+str(os.getpid())+'.tmp'
+    with open(tmp_path, 'w') as handle:
+        json.dump({'settings': settings, 'train': train_files, 'validation': validation_files}, handle)
+    os.replace(tmp_path, manifest_path)
+    return train_files, validation_files
@@ -0,0 +1,168 @@
+""" Post-training quantization of a trained autoencoder for CPU serving.
+
+The model is first rewritten for inference (export_model.inference_model: BatchNormalization
+folded, dropout removed) and converted to TFLite variants:
+    - float32: reference TFLite, no quantization.
+    - float16: float16 weights.
+    - int8: int8 weights and activations, calibrated with a random subset of the test PNGs.
+Every variant is evaluated with TestMetricWrapper (same per-image MSE, DSSIM and PSNR as the
+report) on the test PNGs not used for calibration, and variants whose mean PSNR drops more
+than MAX_PSNR_DROP dB from the .h5 are rejected (their .tflite is deleted). CPU latency of
+the .h5 and of every accepted variant is measured with export_model.benchmark_artifacts.
+
+Usage:
+    python quantize_model.py results/Data_Aug/mse/res_skip_cae_MSE_AUG -o quantized
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import glob
+import json
+import os
+import random
+import tensorflow as tf
+from my_tf_data_loader_optimized import tf_data_png_loader
+from export_model import inference_model, load_predictor, benchmark_artifacts
+from create_test_report import TestMetricWrapper
+
+TEST_img_PATH = '..'+os.path.sep+'IXI-T1'+os.path.sep+'PNG'+os.path.sep+'test_folder'+os.path.sep+'test'
+VARIANTS = ['float32', 'float16', 'int8']
+N_CALIBRATION = 200 #test slices used to calibrate the int8 ranges, excluded from the evaluation
+MAX_PSNR_DROP = 0.5 #dB
+SEED = 42
+
+
+def representative_dataset(calibration_files, resize=(128,128)):
+    """Calibration batches for the int8 converter, preprocessed like the test set."""
+    ds = tf_data_png_loader(calibration_files, batch_size=1, resize=resize, train=False).get_tf_ds_generator()
+    def generator():
+        for batchx, _ in ds:
+            yield [batchx]
+    return generator
+
+
+def convert(model, variant, calibration_files=None):
+    """TFLite flatbuffer of a quantization variant.
+
+    Args:
+        model (tf.keras.Model): inference model.
+        variant (str): one of VARIANTS.
+        calibration_files (list, optional): PNGs for the int8 calibration. Defaults to None.
+
+    Returns:
+        [bytes]: .tflite content
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    if variant == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'int8':
+        if not calibration_files:
+            raise Exception('int8 quantization needs calibration files')
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset(calibration_files, tuple(model.input_shape[1:3]))
+        #int8 kernels inside, float32 input and output so the predictors are interchangeable
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif variant != 'float32':
+        raise Exception('Unknown quantization variant '+variant)
+    return converter.convert()
+
+
+def quantize(model_folder, test_files, save_dir, variants=VARIANTS, n_calibration=N_CALIBRATION,
+             max_psnr_drop=MAX_PSNR_DROP, seed=SEED, metric_store_path=None, benchmark=True):
+    """Quantize the model of a result folder, evaluate the variants and apply the PSNR gate.
+
+    Args:
+        model_folder (str): result folder with one .h5 model.
+        test_files (list): test .png slices.
+        save_dir (str): folder for the .tflite variants and the report.
+        variants (list, optional): some of VARIANTS. Defaults to VARIANTS.
+        n_calibration (int, optional): test slices for int8 calibration. Defaults to N_CALIBRATION.
+        max_psnr_drop (float, optional): maximum mean PSNR drop (dB) of an accepted variant.
+            Defaults to MAX_PSNR_DROP.
+        seed (int, optional): seed of the calibration subset. Defaults to SEED.
+        metric_store_path (str, optional): metric store of TestMetricWrapper. The evaluation files
+            are a test set of their own in the store, so the .h5 metrics on the whole test set
+            written by create_test_report are neither replaced nor reused. Defaults to None.
+        benchmark (bool, optional): measure CPU latency of the accepted variants. Defaults to True.
+
+    Returns:
+        [dict]: report with the metrics, PSNR drop, acceptance and latency of every variant
+    """
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    test_files = sorted(test_files)
+    calibration_files = random.Random(seed).sample(test_files, min(n_calibration, len(test_files)//2))
+    evaluation_files = sorted(set(test_files) - set(calibration_files))
+
+    #the store keys the metrics by test set: the calibration slices are excluded here, so these
+    #are stored apart from the whole test set evaluation of the same model
+    report_wrapper = TestMetricWrapper([model_folder], evaluation_files, metric_store_path=metric_store_path)
+    model_name, model = report_wrapper.models.get(model_folder)
+    exported, _, _ = inference_model(model)
+
+    paths = dict()
+    for variant in variants:
+        paths[model_name+'_'+variant] = os.path.join(save_dir, model_name+'_'+variant+'.tflite')
+        with open(paths[model_name+'_'+variant], 'wb') as f:
+            f.write(convert(exported, variant, calibration_files))
+
+    report = {'model': model_name,
+              'calibration_files': len(calibration_files),
+              'evaluation_files': len(evaluation_files),
+              'max_psnr_drop': max_psnr_drop,
+              'h5': report_wrapper.get_custom_evaluation()[model_name],
+              'variants': dict()}
+    evaluation = report_wrapper.get_predictor_evaluation({name: load_predictor('tflite', path)
+                                                          for name, path in paths.items()})
+    for name, path in paths.items():
+        psnr_drop = report['h5']['psnr_mean'] - evaluation[name]['psnr_mean']
+        accepted = bool(psnr_drop <= max_psnr_drop)
+        report['variants'][name] = dict(evaluation[name], psnr_drop=psnr_drop, accepted=accepted,
+                                        size_mb=os.path.getsize(path) / 2**20)
+        if not accepted:
+            os.remove(path)
+
+    if benchmark:
+        artifacts = {'h5': report_wrapper.models.model_path(model_folder)}
+        artifacts.update({name: path for name, path in paths.items() if report['variants'][name]['accepted']})
+        latencies = {r['format']: r for r in benchmark_artifacts(artifacts)}
+        report['h5']['latency_p50_ms'] = latencies['h5']['latency_p50_ms']
+        for name in paths:
+            if name in latencies:
+                report['variants'][name]['latency_p50_ms'] = latencies[name]['latency_p50_ms']
+                report['variants'][name]['speedup'] = latencies['h5']['latency_p50_ms'] / latencies[name]['latency_p50_ms']
+
+    with open(os.path.join(save_dir, model_name+'_quantization.json'), 'w') as f:
+        json.dump(report, f, indent=1, default=float)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Post-training float16/int8 quantization with a PSNR gate.')
+    parser.add_argument('model_folders', nargs='+', help='result folders, each with one .h5 model')
+    parser.add_argument('-t', '--test-folder', default=TEST_img_PATH, help='folder of the test .png slices')
+    parser.add_argument('-o', '--output', default='quantized')
+    parser.add_argument('-v', '--variants', nargs='+', default=VARIANTS, choices=VARIANTS)
+    parser.add_argument('-c', '--calibration', type=int, default=N_CALIBRATION)
+    parser.add_argument('--max-psnr-drop', type=float, default=MAX_PSNR_DROP)
+    parser.add_argument('--metric-store', default=None)
+    parser.add_argument('--no-bench', action='store_true')
+    args = parser.parse_args()
+
+    test_files = glob.glob(args.test_folder+os.path.sep+'*.png')
+    for model_folder in args.model_folders:
+        report = quantize(model_folder, test_files, args.output, args.variants, args.calibration,
+                          args.max_psnr_drop, metric_store_path=args.metric_store, benchmark=not args.no_bench)
+        print('{} - h5 PSNR {:.3f} dB'.format(report['model'], report['h5']['psnr_mean']))
+        for name, r in report['variants'].items():
+            print('  {:<45} PSNR {:.3f} dB (drop {:+.3f}) {} {}'.format(
+                  name, r['psnr_mean'], r['psnr_drop'], 'ACCEPTED' if r['accepted'] else 'REJECTED',
+                  '- {:.1f}x faster'.format(r['speedup']) if 'speedup' in r else ''))
+
+
+if __name__ == "__main__":
+    main()
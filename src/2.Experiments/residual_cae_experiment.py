@@ -8,23 +8,33 @@ from tensorflow.keras.callbacks import CSVLogger, ModelCheckpoint, EarlyStopping
 from tensorflow.keras.optimizers import RMSprop
 from tensorflow.keras.losses import MSE
 from tensorflow.keras.utils import plot_model
+from tensorflow.keras.models import load_model
+from tensorflow.random import set_seed
 from tensorflow import math as tfmath
 from tensorflow import image as tfimage
+from tensorflow import cast, float32
 import glob
 import os
-import random
+import pickle as pkl
+import shutil
+import tempfile
 import time
 #My modules and classes
 from residual_cae import build_res_encoder
 from residual_cae_myronenko import build_myronenko_cae
 from skip_connection_cae import build_skcon_cae
 from res_skip_cae import build_res_skip_cae
+from patient_split import load_or_create_split, patient_level_split, ixi_id
+from training_modes import set_mixed_precision, float32_output_head, xla_compile_kwargs, StepTimeLogger
+from distribution import get_strategy, cluster_info, DISTRIBUTION_OPTIONS
 #Data Loader
-from my_tf_data_loader_optimized import tf_data_png_loader
+from my_tf_data_loader_optimized import tf_data_png_loader, PipelineCheckpoint
+from tfrecord_shards import read_meta, files_digest
+from nifti_slices import count_slices
 
 #Custom tf execution
-physical_devices = list_physical_devices('GPU')
-set_memory_growth(physical_devices[0], True)
+for physical_device in list_physical_devices('GPU'):
+    set_memory_growth(physical_device, True)
 
 #EXPERIMENT CONFIGURABLE OPTIONS
 NETWORK_ARCHITECTURE = 'res_skip_cae' #See architecture options
@@ -37,9 +47,17 @@ BUILDING_BLOCK = 'full_pre' #only relevant in small_res_cae - Se block options
 MODEL_NAME = NETWORK_ARCHITECTURE+'_'+METRIC
 
 EPOCHS = 100
-BATCH_SIZE = 32
-train_percentage = 0.85
+BATCH_SIZE = 32 #per replica, the global batch is BATCH_SIZE*replicas
+train_percentage = 0.85 #of the train_and_val volumes, split by patient
 INPUT_SHAPE = (128,128)
+SEED = 42 #Seeds split, weights init, shuffles and augmentation. None for unseeded runs (no resume)
+RESUME_PATH = None #Results folder of a preempted run to resume from its last checkpoint
+SNAPSHOT_DIR = 'cache' #Persistent decoded-image snapshots reused across runs. None to decode PNGs every run. Not used with NIFTI_PATH
+TFRECORD_DIR = None #Folder with the train and validation TFRecord shards of the split (tfrecord_shards.py). None reads the PNGs
+NIFTI_PATH = None #Glob of .nii.gz volumes to train on without extracting the slices (nifti_slices.py), and without a snapshot on disk. None reads the PNGs
+MIXED_PRECISION = False #mixed_float16 policy, the output layer and the losses stay in float32
+XLA = False #XLA compilation of the train step
+DISTRIBUTION = None #See distribution options. None with a multi-worker TF_CONFIG means 'multi_worker'
 
 #############################
 # Check experiment options
@@ -54,9 +72,11 @@ architecure_options = ['small_res_cae',
 ]
 
 def DSSIM(y_true, y_pred):
+    y_true, y_pred = cast(y_true, float32), cast(y_pred, float32)
     return tfmath.divide(tfmath.subtract(1.0,tfimage.ssim(y_true, y_pred, max_val=1.0)),2.0)
 
 def PSNR(y_true, y_pred):
+    y_true, y_pred = cast(y_true, float32), cast(y_pred, float32)
     return tfimage.psnr(y_true, y_pred, max_val=1.0)
 
 loss_options = ['MSE',
@@ -71,6 +91,18 @@ loss_options = [eval(i) for i in loss_options]
 
 assert NETWORK_ARCHITECTURE in architecure_options,'Network does not belong to the possible ones'
 assert BUILDING_BLOCK in block_options,'Bulinding block not implemented'
+assert DISTRIBUTION in DISTRIBUTION_OPTIONS,'Distribution does not belong to the possible ones'
+assert not (TFRECORD_DIR and NIFTI_PATH),'Choose one data source: TFRECORD_DIR or NIFTI_PATH'
+
+##########################
+#Distribution (before any other tf op)
+strategy, DISTRIBUTION = get_strategy(DISTRIBUTION)
+NUM_WORKERS, WORKER_INDEX = cluster_info() if DISTRIBUTION=='multi_worker' else (1, 0)
+CHIEF = WORKER_INDEX == 0 #only the chief writes results
+#Every worker batches its own shard with the global batch: tf.distribute splits each worker
+#batch over all the replicas, so every replica gets BATCH_SIZE slices per step
+GLOBAL_BATCH_SIZE = BATCH_SIZE * strategy.num_replicas_in_sync
+assert DISTRIBUTION!='multi_worker' or SEED is not None,'Workers need a SEED to compute the same patient split'
 
 ##########################
 #Results PATH
@@ -78,42 +110,103 @@ reduce_lr_str = '_LRPlat' if REDUCE_LR_PLATEAU else '_NoPlat'
 kreg_str = '_L2KReg' if KERNEL_REGULARIZATION else '_NoKReg'
 block_str = '_'+BUILDING_BLOCK if NETWORK_ARCHITECTURE=='small_res_cae' else ''
 augment_str = '_AUG' if AUGMENT else ''
-MODEL_NAME+= block_str+augment_str+kreg_str+reduce_lr_str
+speed_str = ('_MP' if MIXED_PRECISION else '')+('_XLA' if XLA else '')
+MODEL_NAME+= block_str+augment_str+kreg_str+reduce_lr_str+speed_str
 
 RES_PATH = 'results'+os.path.sep+MODEL_NAME+'_T'+time.strftime('%d_%m_%y__%H_%M') 
-if not os.path.exists(RES_PATH):
-    os.mkdir(RES_PATH) 
+if RESUME_PATH:
+    RES_PATH = RESUME_PATH
+LAST_MODEL_PATH = RES_PATH+os.path.sep+MODEL_NAME+'_last.h5'
+PIPELINE_STATE_PATH = RES_PATH+os.path.sep+MODEL_NAME+'_pipeline.json'
+if CHIEF:
+    WRITE_PATH = RES_PATH
+    if not os.path.exists(RES_PATH):
+        os.mkdir(RES_PATH) 
+else:
+    #Other workers take part in the checkpoint saves, but into a folder deleted at the end
+    WRITE_PATH = tempfile.mkdtemp(prefix=MODEL_NAME+'_worker'+str(WORKER_INDEX)+'_')
+if NIFTI_PATH:
+    #a snapshot of the volumes would be a float32 copy of every relevant slice on disk
+    SNAPSHOT_DIR = None
+if SNAPSHOT_DIR:
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
 
 ########################
 #Data Splitting
 TRAIN_img_PATH = '..'+os.path.sep+'IXI-T1'+os.path.sep+'PNG'+os.path.sep+'train_val_folder'+os.path.sep+'train_and_val'
 TEST_img_PATH = '..'+os.path.sep+'IXI-T1'+os.path.sep+'PNG'+os.path.sep+'test_folder'+os.path.sep+'test'
 
-#Load train paths
-trainval_img_files = glob.glob(TRAIN_img_PATH+os.path.sep+'*.png')
-random.shuffle(trainval_img_files)
+SPLIT_MANIFEST = 'splits'+os.path.sep+'patient_split_seed'+str(SEED)+'.json'
+
+#Split train_val dataset by IXI subject, so no volume has slices in both partitions.
+#The split is cached in SPLIT_MANIFEST and reused while its settings do not change
+if NIFTI_PATH:
+    #Same patient split, of the train_and_val volumes themselves
+    with open('data_train_val_volumes_df.pkl', 'rb') as f:
+        train_val_vols = pkl.load(f)
+    train_val_ids = set(train_val_vols.IXI_ID.astype(int))
+    volume_files = [f for f in sorted(glob.glob(NIFTI_PATH)) if ixi_id(f) in train_val_ids]
+    train_img_files, validation_img_files = patient_level_split(volume_files, train_val_vols,
+                                                                validation_size=round(1-train_percentage, 4),
+                                                                seed=SEED)
+else:
+    train_img_files, validation_img_files = load_or_create_split(SPLIT_MANIFEST,
+                                                                 TRAIN_img_PATH,
+                                                                 'data_train_val_volumes_df.pkl',
+                                                                 validation_size=round(1-train_percentage, 4),
+                                                                 seed=SEED)
+
+#Resume state
+initial_epoch, initial_step, callback_state = 0, 0, None
+if RESUME_PATH:
+    assert SEED is not None,'Only seeded runs can be resumed'
+    pipeline_state = PipelineCheckpoint.load_state(PIPELINE_STATE_PATH)
+    assert pipeline_state['seed']==SEED,'Resumed run must use the seed of the original run'
+    assert pipeline_state.get('steps_per_batch', 1)==NUM_WORKERS,'Resumed run must use the workers of the original run'
+    #state['step'] counts loader batches, the unit of the loader initial_step. PipelineCheckpoint
+    #(steps_per_batch=NUM_WORKERS) converts them to and from training steps, NUM_WORKERS per batch
+    initial_epoch, initial_step = pipeline_state['epoch'], pipeline_state['step']
+    callback_state = pipeline_state.get('callbacks')
+if SEED is not None:
+    set_seed(SEED)
 
-#Split train_val dataset
-lim = int(len(trainval_img_files)*train_percentage)
-train_img_files = trainval_img_files[:lim]
-validation_img_files = trainval_img_files[lim:]
+#TFRecord shards must hold exactly the slices of the split
+sources = {'train': train_img_files, 'validation': validation_img_files}
+if TFRECORD_DIR:
+    for split, split_files in sources.items():
+        shard_dir = TFRECORD_DIR+os.path.sep+split
+        if not os.path.isdir(shard_dir) or read_meta(shard_dir)['digest'] != files_digest(split_files):
+            raise Exception(shard_dir+' does not match the split, run: python tfrecord_shards.py --split-manifest '
+                            +SPLIT_MANIFEST+' -o '+TFRECORD_DIR)
+        sources[split] = shard_dir
 
 #Create data loaders
-params = {'batch_size': BATCH_SIZE,
+params = {'batch_size': GLOBAL_BATCH_SIZE,
           'cache':False,
           'shuffle_buffer_size':1000,
-          'resize':INPUT_SHAPE
+          'resize':INPUT_SHAPE,
+          'snapshot_dir':SNAPSHOT_DIR,
+          'num_shards':NUM_WORKERS,
+          'shard_index':WORKER_INDEX,
+          'source':'tfrecord' if TFRECORD_DIR else 'nifti' if NIFTI_PATH else 'files'
          }
 #train         
-train_loader = tf_data_png_loader(train_img_files, **params, augment=AUGMENT)
+train_loader = tf_data_png_loader(sources['train'], **params, augment=AUGMENT, snapshot_name='train',
+                                  seed=SEED, initial_step=initial_step)
 train_ds = train_loader.get_tf_ds_generator()
 #validation
-validation_loader = tf_data_png_loader(validation_img_files, **params, augment=False)
+validation_loader = tf_data_png_loader(sources['validation'], **params, augment=False, snapshot_name='validation')
 validation_ds = validation_loader.get_tf_ds_generator()
 
 #Train parameters for model.fit with generators
-STEP_SIZE_TRAIN = len(train_img_files) // train_loader.batch_size
-STEP_SIZE_VALID = len(validation_img_files) // validation_loader.batch_size
+train_samples, validation_samples = len(train_img_files), len(validation_img_files)
+if NIFTI_PATH:
+    train_samples, validation_samples = count_slices(train_img_files), count_slices(validation_img_files)
+STEP_SIZE_TRAIN = train_samples // GLOBAL_BATCH_SIZE
+#Every step takes 1/NUM_WORKERS of a loader batch of each worker: epochs of whole loader
+#batches, so the pipeline checkpoint of every epoch resumes at a loader batch
+STEP_SIZE_TRAIN = max(NUM_WORKERS, STEP_SIZE_TRAIN - STEP_SIZE_TRAIN % NUM_WORKERS)
+STEP_SIZE_VALID = validation_samples // GLOBAL_BATCH_SIZE
 
 ###############################
 #Callbacks Parameters
@@ -124,44 +217,77 @@ elif METRIC == 'DSSIM':
     stopping_min_delta = 5e-5
     reducer_min_delta = 2e-5
 #Callbacks
-my_callbacks = [CSVLogger(RES_PATH+os.path.sep+MODEL_NAME+'.csv', separator=";", append=False),
-                ModelCheckpoint(filepath=RES_PATH+os.path.sep+MODEL_NAME+'.h5', #.{epoch:02d}-{val_loss:.2f}
+#StepTimeLogger first, so its step times reach the CSVLogger
+my_callbacks = [StepTimeLogger(GLOBAL_BATCH_SIZE),
+                ModelCheckpoint(filepath=WRITE_PATH+os.path.sep+MODEL_NAME+'.h5', #.{epoch:02d}-{val_loss:.2f}
                                 monitor='val_loss',
                                 mode='min',
                                 save_best_only=True),
                 EarlyStopping(monitor='val_loss', mode='min', verbose=1, patience=20, min_delta=stopping_min_delta)
                 ]
+if CHIEF:
+    my_callbacks.insert(1, CSVLogger(RES_PATH+os.path.sep+MODEL_NAME+'.csv', separator=";", append=bool(RESUME_PATH)))
 #Learninrg Rate reducer
 if REDUCE_LR_PLATEAU:
     my_callbacks.append(ReduceLROnPlateau(monitor='val_loss', factor=0.2,
                                           patience=4, min_lr=1e-7, 
                                           min_delta=reducer_min_delta,
                                           verbose=1))
+#Last model, pipeline position and callbacks progress, to resume after preemption.
+#Last in the list, so it saves the progress of the epoch the other callbacks just evaluated
+if SEED is not None:
+    my_callbacks.append(PipelineCheckpoint(WRITE_PATH+os.path.sep+MODEL_NAME+'_last.h5',
+                                           WRITE_PATH+os.path.sep+MODEL_NAME+'_pipeline.json',
+                                           seed=SEED, initial_step=initial_step, steps_per_batch=NUM_WORKERS,
+                                           callbacks=[c for c in my_callbacks
+                                                      if isinstance(c, (ModelCheckpoint, EarlyStopping, ReduceLROnPlateau))],
+                                           callback_state=callback_state))
 
 #MODEL FIT
-if NETWORK_ARCHITECTURE == 'small_res_cae':
-    autoencoder =  build_res_encoder(INPUT_SHAPE+(1,), block_type=BUILDING_BLOCK, ker_reg=KERNEL_REGULARIZATION) #,  params.get('batch_size'))
-elif NETWORK_ARCHITECTURE == 'myronenko_cae':
-    autoencoder =  build_myronenko_cae(INPUT_SHAPE+(1,), ker_reg=KERNEL_REGULARIZATION)
-elif NETWORK_ARCHITECTURE == 'skip_con_cae':
-    autoencoder = build_skcon_cae(INPUT_SHAPE+(1,), ker_reg=KERNEL_REGULARIZATION)
-elif NETWORK_ARCHITECTURE == 'res_skip_cae':
-    autoencoder = build_res_skip_cae(INPUT_SHAPE+(1,), block_type=BUILDING_BLOCK, ker_reg=KERNEL_REGULARIZATION)
-else:
-    raise('Architecture not implemented')
+set_mixed_precision(MIXED_PRECISION)
+#Variables (model and optimizer) created in the strategy scope, mirrored on every replica
+with strategy.scope():
+    if NETWORK_ARCHITECTURE == 'small_res_cae':
+        autoencoder =  build_res_encoder(INPUT_SHAPE+(1,), block_type=BUILDING_BLOCK, ker_reg=KERNEL_REGULARIZATION) #,  params.get('batch_size'))
+    elif NETWORK_ARCHITECTURE == 'myronenko_cae':
+        autoencoder =  build_myronenko_cae(INPUT_SHAPE+(1,), ker_reg=KERNEL_REGULARIZATION)
+    elif NETWORK_ARCHITECTURE == 'skip_con_cae':
+        autoencoder = build_skcon_cae(INPUT_SHAPE+(1,), ker_reg=KERNEL_REGULARIZATION)
+    elif NETWORK_ARCHITECTURE == 'res_skip_cae':
+        autoencoder = build_res_skip_cae(INPUT_SHAPE+(1,), block_type=BUILDING_BLOCK, ker_reg=KERNEL_REGULARIZATION)
+    else:
+        raise('Architecture not implemented')
+    if MIXED_PRECISION:
+        autoencoder = float32_output_head(autoencoder)
 
-#Compile, save diagram and fit
-autoencoder.compile(loss=loss_function, 
-                    optimizer=RMSprop(),
-                    metrics=loss_options)
-plot_model(autoencoder, to_file=RES_PATH+os.path.sep+MODEL_NAME+".png", show_shapes=True, show_layer_names=True, rankdir="TD")
+    #Compile, save diagram and fit
+    if RESUME_PATH:
+        #Weights and optimizer state of the last checkpoint
+        autoencoder = load_model(LAST_MODEL_PATH, custom_objects = {'DSSIM':DSSIM, 'PSNR':PSNR})
+        if XLA:
+            #same optimizer object, so its restored state is kept
+            autoencoder.compile(loss=loss_function,
+                                optimizer=autoencoder.optimizer,
+                                metrics=loss_options,
+                                **xla_compile_kwargs(XLA))
+    else:
+        autoencoder.compile(loss=loss_function, 
+                            optimizer=RMSprop(),
+                            metrics=loss_options,
+                            **xla_compile_kwargs(XLA))
+if CHIEF and not RESUME_PATH:
+    plot_model(autoencoder, to_file=RES_PATH+os.path.sep+MODEL_NAME+".png", show_shapes=True, show_layer_names=True, rankdir="TD")
 history = autoencoder_train = autoencoder.fit(train_ds,
-                                              epochs=100,
+                                              epochs=EPOCHS,
+                                              initial_epoch=initial_epoch,
                                               #batch_size=train_loader.batch_size,
                                               steps_per_epoch = STEP_SIZE_TRAIN,
                                               validation_data = validation_ds, 
                                               validation_steps = STEP_SIZE_VALID,
-                                              verbose=1,
+                                              verbose=1 if CHIEF else 0,
                                               callbacks = my_callbacks,
                                               max_queue_size = 50
-                                             )
\ No newline at end of file
+                                             )
+
+if not CHIEF:
+    shutil.rmtree(WRITE_PATH, ignore_errors=True)
@@ -1,6 +1,8 @@
 
 __author__= 'Adrian Arnaiz'
 
+import numpy as np
+
 
 def stratified_sample(df, strata, size=None, seed=None, keep_index= True):
     '''
@@ -43,38 +45,29 @@ def stratified_sample(df, strata, size=None, seed=None, keep_index= True):
     '''
     population = len(df)
     size = __smpl_size(population, size)
-    tmp = df[strata]
-    tmp['size'] = 1
-    tmp_grpd = tmp.groupby(strata).count().reset_index()
-    tmp_grpd['samp_size'] = round(size/population * tmp_grpd['size']).astype(int)
 
-    # controlling variable to create the dataframe or append to it
-    first = True 
-    for i in range(len(tmp_grpd)):
-        # query generator for each iteration
-        qry=''
-        for s in range(len(strata)):
-            stratum = strata[s]
-            value = tmp_grpd.iloc[i][stratum]
-            n = tmp_grpd.iloc[i]['samp_size']
+    # stratum number of every row (-1 for missing values), strata in sorted order as in
+    # stratified_sample_report, computed in one groupby instead of one query per stratum
+    codes = df.groupby(strata, sort=True, observed=True).ngroup().fillna(-1).to_numpy().astype(int)
+    valid = codes >= 0
+    rows = np.flatnonzero(valid)
+    rows = rows[np.argsort(codes[valid], kind='stable')]
+    counts = np.bincount(codes[valid])
+    samp_sizes = np.round(size/population * counts).astype(int)
 
-            if type(value) == str:
-                value = "'" + str(value) + "'"
-            
-            if s != len(strata)-1:
-                qry = qry + stratum + ' == ' + str(value) +' & '
-            else:
-                qry = qry + stratum + ' == ' + str(value)
-        
-        # final dataframe
-        if first:
-            stratified_df = df.query(qry).sample(n=n, random_state=seed).reset_index(drop=(not keep_index))
-            first = False
+    # same draws as DataFrame.sample(n, random_state=seed) on each stratum
+    selected = []
+    for stratum_rows, n in zip(np.split(rows, np.cumsum(counts)[:-1]), samp_sizes):
+        if seed is None:
+            random_state = np.random
+        elif isinstance(seed, np.random.RandomState):
+            random_state = seed
         else:
-            tmp_df = df.query(qry).sample(n=n, random_state=seed).reset_index(drop=(not keep_index))
-            stratified_df = stratified_df.append(tmp_df, ignore_index=True)
-    
-    return stratified_df
+            random_state = np.random.RandomState(seed)
+        selected.append(stratum_rows[random_state.choice(len(stratum_rows), size=n, replace=False)])
+    selected = np.concatenate(selected) if selected else np.array([], dtype=int)
+
+    return df.iloc[selected].reset_index(drop=(not keep_index))
 
 
 
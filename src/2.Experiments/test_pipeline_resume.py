@@ -0,0 +1,105 @@
+""" A multi-worker training resumed from its PipelineCheckpoint sees the same batches as an
+uninterrupted one.
+
+Two localhost workers (launch_local_workers.py) train a tiny model on 16-bit PNG slices that
+hold their slice number in one pixel, with tf_data_png_loader sharded by worker. A layer records
+the slices of every training step. Every worker trains 2 epochs uninterrupted, then 1 epoch
+with a PipelineCheckpoint and 1 more resumed from its state, and the second epochs must match.
+
+Usage:
+    python -m pytest test_pipeline_resume.py
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import glob
+import json
+import os
+import sys
+import numpy as np
+
+N_WORKERS = 2
+N_SLICES = 96
+BATCH_SIZE = 4
+STEPS_PER_EPOCH = 4
+SEED = 7
+BASE_PORT = 21200
+
+
+def write_slices(folder):
+    import tensorflow as tf
+    for i in range(N_SLICES):
+        img = np.zeros((256, 256, 1), np.uint16)
+        #0 and 65535 fix the min-max normalization, so the slice number survives it
+        img[0, 1], img[0, 2] = 65535, 100*(i+1)
+        img = tf.constant(img)
+        tf.io.write_file(os.path.join(folder, 'IXI{:03d}-Guys-0000-T1_{}.png'.format(i, i)), tf.io.encode_png(img))
+
+
+def worker(png_folder, out_folder):
+    """Batches seen by this worker, uninterrupted and resumed, written to out_folder/worker_<i>.json."""
+    from distribution import get_strategy, cluster_info
+    strategy, _ = get_strategy('multi_worker')
+    import tensorflow as tf
+    from my_tf_data_loader_optimized import tf_data_png_loader, PipelineCheckpoint
+    n_workers, index = cluster_info()
+    files = sorted(glob.glob(os.path.join(png_folder, '*.png')))
+    global_batch_size = BATCH_SIZE * strategy.num_replicas_in_sync
+    write_path = os.path.join(out_folder, 'worker_'+str(index))
+    os.makedirs(write_path, exist_ok=True)
+    seen = []
+
+    class Probe(tf.keras.layers.Layer):
+        def call(self, x):
+            #slice number of every image of the step
+            tf.py_function(lambda v: seen.append(np.round(v.numpy()*65535/100-1).astype(int).tolist()), [x[:, 0, 2, 0]], [])
+            return x
+
+    def fit(initial_epoch, epochs, initial_step=0, callbacks=()):
+        loader = tf_data_png_loader(files, batch_size=global_batch_size, resize=None, seed=SEED,
+                                    initial_step=initial_step, num_shards=n_workers, shard_index=index)
+        with strategy.scope():
+            inputs = tf.keras.Input((256, 256, 1))
+            model = tf.keras.Model(inputs, tf.keras.layers.Conv2D(1, 3, padding='same')(Probe()(inputs)))
+            model.compile(optimizer='sgd', loss='mse')
+        del seen[:]
+        model.fit(loader.get_tf_ds_generator(), initial_epoch=initial_epoch, epochs=epochs,
+                  steps_per_epoch=STEPS_PER_EPOCH, callbacks=list(callbacks), verbose=0)
+        return list(seen)
+
+    uninterrupted = fit(0, 2)[STEPS_PER_EPOCH:]
+    state_path = os.path.join(write_path, 'pipeline.json')
+    fit(0, 1, callbacks=[PipelineCheckpoint(os.path.join(write_path, 'last.h5'), state_path, seed=SEED,
+                                            steps_per_batch=n_workers)])
+    state = PipelineCheckpoint.load_state(state_path)
+    resumed = fit(state['epoch'], 2, initial_step=state['step'])
+    with open(os.path.join(out_folder, 'worker_'+str(index)+'.json'), 'w') as handle:
+        json.dump({'state': state, 'uninterrupted': uninterrupted, 'resumed': resumed}, handle)
+
+
+def test_multi_worker_resume(tmp_path):
+    from launch_local_workers import launch
+    png_folder, out_folder = str(tmp_path/'png'), str(tmp_path/'out')
+    os.makedirs(png_folder)
+    os.makedirs(out_folder)
+    write_slices(png_folder)
+    assert launch(os.path.abspath(__file__), N_WORKERS, base_port=BASE_PORT, cpu=True,
+                  log_dir=str(tmp_path/'logs'), script_args=[png_folder, out_folder]) == 0
+
+    shards = []
+    for index in range(N_WORKERS):
+        with open(os.path.join(out_folder, 'worker_'+str(index)+'.json')) as handle:
+            result = json.load(handle)
+        #an epoch of STEPS_PER_EPOCH steps takes STEPS_PER_EPOCH/N_WORKERS batches of the worker
+        assert result['state']['step'] == STEPS_PER_EPOCH // N_WORKERS
+        assert len(result['resumed']) == STEPS_PER_EPOCH
+        assert result['resumed'] == result['uninterrupted']
+        shards.append(set(np.ravel(result['resumed'])))
+    #every worker reads its own shard
+    assert not shards[0] & shards[1]
+
+
+if __name__ == "__main__":
+    worker(*sys.argv[1:])
@@ -0,0 +1,203 @@
+""" Sharded TFRecord copy of the extracted slices, read by tf_data_png_loader(source='tfrecord').
+
+Each partition is written as a folder of GZIP compressed shards, so the loader does a few large
+sequential reads instead of opening one small file per slice. Every record keeps the slice file
+content as it is (PNG bytes, or the array bytes of .npy slices) and its metadata:
+    image (bytes), format ('png' or 'raw'), shape (int64 list), dtype (str),
+    slice_id (str, file name without extension), ixi_id (int64), brain_quantity (float, -1 if unknown).
+The folder also has meta.json with the number of records of every shard and the image format,
+shape and dtype of the partition, that are the same for all its slices.
+Slices are shuffled with a seed before being dealt to the shards, so every shard mixes volumes.
+
+Usage:
+    python tfrecord_shards.py ../IXI-T1/PNG/test_folder/test -o ../IXI-T1/TFRecord/test
+    python tfrecord_shards.py --split-manifest splits/patient_split_seed42.json -o ../IXI-T1/TFRecord
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import random
+import shutil
+import struct
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+BRAIN_QUANTITY_PATH = '..'+os.path.sep+'IXI-T1'+os.path.sep+'slice_brain_quantity.csv'
+META_NAME = 'meta.json'
+COMPRESSION = 'GZIP'
+N_SHARDS = 16
+SEED = 42
+
+FEATURES = {'image': tf.io.FixedLenFeature([], tf.string),
+            'format': tf.io.FixedLenFeature([], tf.string),
+            'shape': tf.io.VarLenFeature(tf.int64),
+            'dtype': tf.io.FixedLenFeature([], tf.string),
+            'slice_id': tf.io.FixedLenFeature([], tf.string),
+            'ixi_id': tf.io.FixedLenFeature([], tf.int64),
+            'brain_quantity': tf.io.FixedLenFeature([], tf.float32)}
+
+
+def load_brain_quantity(csv_path=BRAIN_QUANTITY_PATH):
+    """Slice ID -> brain quantity, empty if the table does not exist."""
+    if not os.path.isfile(csv_path):
+        return dict()
+    table = pd.read_csv(csv_path)
+    return dict(zip(table['ID'], table['BRAIN_QUANTITY']))
+
+
+def slice_content(file_path):
+    """Bytes, format, shape and dtype of a slice file (.png kept encoded, .npy as raw array bytes)."""
+    if file_path.endswith('.npy'):
+        img = np.load(file_path)
+        return img.tobytes(), 'raw', img.shape, img.dtype.name
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    #IHDR chunk of the PNG header: width, height and bit depth, no need to decode
+    width, height, bit_depth = struct.unpack('>IIB', content[16:25])
+    return content, 'png', (height, width), 'uint16' if bit_depth == 16 else 'uint8'
+
+
+def slice_example(file_path, brain_quantity):
+    """tf.train.Example of a slice file.
+
+    Args:
+        file_path (str): .png or .npy slice, named '<volume>_<sagittal slice>'.
+        brain_quantity (dict): slice ID -> brain quantity, see load_brain_quantity.
+
+    Returns:
+        [tuple]: (serialized example, format, shape, dtype)
+    """
+    content, img_format, shape, dtype = slice_content(file_path)
+    slice_id = os.path.splitext(os.path.basename(file_path))[0]
+    feature = {'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[content])),
+               'format': tf.train.Feature(bytes_list=tf.train.BytesList(value=[img_format.encode()])),
+               'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=list(shape))),
+               'dtype': tf.train.Feature(bytes_list=tf.train.BytesList(value=[dtype.encode()])),
+               'slice_id': tf.train.Feature(bytes_list=tf.train.BytesList(value=[slice_id.encode()])),
+               'ixi_id': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(slice_id[3:6])])),
+               'brain_quantity': tf.train.Feature(float_list=tf.train.FloatList(
+                                                  value=[brain_quantity.get(slice_id, -1.)]))}
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString(), img_format, shape, dtype
+
+
+def files_digest(files):
+    """Hash of a list of slice files and their modification time."""
+    key = {'files': sorted(files), 'mtimes': [os.path.getmtime(f) for f in sorted(files)]}
+    return hashlib.sha1(json.dumps(key).encode()).hexdigest()[:16]
+
+
+def write_shards(files, out_dir, n_shards=N_SHARDS, seed=SEED, brain_quantity_path=BRAIN_QUANTITY_PATH):
+    """Write the slice files into a folder of TFRecord shards.
+
+    The folder is written aside and renamed when complete, so a reader never sees a partial
+    one. If out_dir already holds the same files (same digest in meta.json) nothing is written.
+
+    Args:
+        files (list): .png or .npy slices of one partition, all of the same format, shape and dtype.
+        out_dir (str): folder of the shards.
+        n_shards (int, optional): number of shards. Defaults to N_SHARDS.
+        seed (int, optional): seed of the order of the slices in the shards. Defaults to SEED.
+        brain_quantity_path (str, optional): slice_brain_quantity.csv. Defaults to BRAIN_QUANTITY_PATH.
+
+    Returns:
+        [dict]: meta of the shards
+    """
+    digest = files_digest(files)
+    if os.path.isfile(os.path.join(out_dir, META_NAME)):
+        meta = read_meta(out_dir)
+        if meta['digest'] == digest:
+            return meta
+    n_shards = max(1, min(n_shards, len(files)))
+    brain_quantity = load_brain_quantity(brain_quantity_path)
+    files = sorted(files)
+    random.Random(seed).shuffle(files)
+
+    tmp_dir = out_dir.rstrip(os.path.sep)+'.'+str(os.getpid())+'.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    options = tf.io.TFRecordOptions(compression_type=COMPRESSION)
+    meta = {'digest': digest, 'compression': COMPRESSION, 'seed': seed, 'shards': dict()}
+    for shard in range(n_shards):
+        shard_name = 'shard-{:05d}-of-{:05d}.tfrecord.gz'.format(shard, n_shards)
+        shard_files = files[shard::n_shards]
+        with tf.io.TFRecordWriter(os.path.join(tmp_dir, shard_name), options) as writer:
+            for file_path in shard_files:
+                example, img_format, shape, dtype = slice_example(file_path, brain_quantity)
+                image = {'format': img_format, 'shape': list(map(int, shape)), 'dtype': dtype}
+                if meta.setdefault('image', image) != image:
+                    raise Exception('Slice '+file_path+' is '+str(image)+', the partition is '+str(meta['image']))
+                writer.write(example)
+        meta['shards'][shard_name] = len(shard_files)
+    meta['examples'] = len(files)
+    with open(os.path.join(tmp_dir, META_NAME), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return meta
+
+
+def read_meta(shard_dir):
+    with open(os.path.join(shard_dir, META_NAME)) as f:
+        return json.load(f)
+
+
+def shard_files(shard_dir):
+    """Shard paths of a folder, sorted, and its meta."""
+    meta = read_meta(shard_dir)
+    return [os.path.join(shard_dir, name) for name in sorted(meta['shards'])], meta
+
+
+def decode_image(serialized, image):
+    """Slice image (H x W x 1) of a serialized example, in the dtype of the partition.
+
+    Args:
+        serialized (tf.Tensor): string tensor of one tf.train.Example.
+        image (dict): format, shape and dtype of the partition, meta['image'] of the shards.
+
+    Returns:
+        [tf.Tensor]: image tensor
+    """
+    example = tf.io.parse_single_example(serialized, FEATURES)
+    shape = list(image['shape'][:2]) + [1]
+    if image['format'] == 'png':
+        img = tf.io.decode_png(example['image'], channels=1, dtype=tf.as_dtype(image['dtype']))
+        return tf.ensure_shape(img, shape)
+    return tf.reshape(tf.io.decode_raw(example['image'], tf.as_dtype(image['dtype'])), shape)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write slices into compressed TFRecord shards.')
+    parser.add_argument('folder', nargs='?', help='folder of .png or .npy slices')
+    parser.add_argument('-o', '--output', required=True, help='shard folder (or parent folder with --split-manifest)')
+    parser.add_argument('--split-manifest', default=None, help='patient_split manifest: writes output/train and output/validation')
+    parser.add_argument('-s', '--shards', type=int, default=N_SHARDS)
+    parser.add_argument('--seed', type=int, default=SEED)
+    parser.add_argument('--brain-quantity', default=BRAIN_QUANTITY_PATH)
+    args = parser.parse_args()
+
+    if args.split_manifest:
+        with open(args.split_manifest) as f:
+            manifest = json.load(f)
+        partitions = {os.path.join(args.output, split): manifest[split] for split in ['train', 'validation']}
+    elif args.folder:
+        partitions = {args.output: glob.glob(args.folder+os.path.sep+'*.png') + glob.glob(args.folder+os.path.sep+'*.npy')}
+    else:
+        parser.error('a slice folder or --split-manifest is needed')
+
+    for out_dir, files in partitions.items():
+        meta = write_shards(files, out_dir, args.shards, args.seed, args.brain_quantity)
+        print(out_dir, '-', meta['examples'], 'slices in', len(meta['shards']), 'shards')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+""" Training speed options of residual_cae_experiment.py: mixed precision, XLA and step time logging.
+"""
+
+__author__ = "Adrian Arnaiz-Rodriguez"
+__email__ = "aarnaizr@uoc.edu"
+__version__ = "1.0.0"
+
+import inspect
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def set_mixed_precision(enabled):
+    """Set the global Keras policy to mixed_float16 (float16 compute, float32 variables) or float32.
+    Must be called before building or loading the model. Loss scaling is added by compile."""
+    policy = 'mixed_float16' if enabled else 'float32'
+    mixed_precision = tf.keras.mixed_precision
+    if hasattr(mixed_precision, 'set_global_policy'):
+        mixed_precision.set_global_policy(policy)
+    else: #TF<2.4
+        mixed_precision.experimental.set_policy(policy)
+
+
+def float32_output_head(model):
+    """Same model with its last layer (the sigmoid Conv2D of every builder) computed in float32,
+    so the reconstruction and the MSE/DSSIM/PSNR losses on it are not float16.
+
+    Args:
+        model (tf.keras.Model): functional model built under the mixed_float16 policy.
+
+    Returns:
+        [tf.keras.Model]: model sharing every layer but the output one
+    """
+    output_layer = model.layers[-1]
+    config = output_layer.get_config()
+    config['dtype'] = 'float32'
+    head = output_layer.__class__.from_config(config)
+    outputs = head(output_layer.input)
+    head.set_weights(output_layer.get_weights())
+    return tf.keras.Model(model.inputs, outputs, name=model.name)
+
+
+def xla_compile_kwargs(enabled):
+    """Extra Model.compile arguments for XLA. Before jit_compile existed in compile (TF<2.5),
+    XLA auto-clustering is enabled globally instead."""
+    if not enabled:
+        return dict()
+    if 'jit_compile' in inspect.signature(tf.keras.Model.compile).parameters:
+        return {'jit_compile': True}
+    tf.config.optimizer.set_jit(True)
+    return dict()
+
+
+class StepTimeLogger(tf.keras.callbacks.Callback):
+    """Add the training step time of every epoch to the logs (and so to CSVLogger, that must
+    come after it in the callback list):
+        step_time_ms: median time of a training step.
+        step_time_p90_ms: 90th percentile, shows the steps waiting for data.
+        images_per_s: batch_size / median step time.
+        epoch_time_s: wall time of the epoch, validation included.
+    """
+
+    def __init__(self, batch_size):
+        """
+        Args:
+            batch_size (int): images per training step.
+        """
+        super().__init__()
+        self.batch_size = batch_size
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._step_times = []
+        self._epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step_times.append(time.perf_counter() - self._step_start)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if logs is None or not self._step_times:
+            return
+        step_time = np.median(self._step_times)
+        logs['step_time_ms'] = step_time * 1000
+        logs['step_time_p90_ms'] = np.percentile(self._step_times, 90) * 1000
+        logs['images_per_s'] = self.batch_size / step_time
+        logs['epoch_time_s'] = time.perf_counter() - self._epoch_start